@@ -63,9 +63,15 @@ CREATE TABLE IF NOT EXISTS activities (
     foreground_app VARCHAR(500),
     app_count INTEGER DEFAULT 0,
     apps_data JSONB,
+    ended_at TIMESTAMP,
+    duration_seconds INTEGER,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Intervalos agregados pelo broadcaster (amostras antigas ficam com NULL = 2s)
+ALTER TABLE activities ADD COLUMN IF NOT EXISTS ended_at TIMESTAMP;
+ALTER TABLE activities ADD COLUMN IF NOT EXISTS duration_seconds INTEGER;
+
 -- Browser history table - stores encrypted navigation history (linked to installation)
 CREATE TABLE IF NOT EXISTS browser_history (
     id SERIAL PRIMARY KEY,
@@ -1,23 +1,126 @@
 const WebSocket = require("ws");
+const { saveSession, takeSession, touchSession } = require("../services/sessions");
 /*
     registerBroadcaster: cadastra um broadcaster e avisa os viewers.
     registerViewer: cadastra um viewer e envia lista de broadcasters.
     handleDisconnect: remove peers desconectados e avisa viewers se broadcaster sair.
     relayMessage: envia mensagens P2P entre peers.
     handleWatch: conecta um viewer a um broadcaster específico.
+    handleSnapshotRequest: pede miniaturas (snapshots) de um broadcaster sem abrir WebRTC.
+    relaySnapshot: entrega um snapshot do broadcaster ao viewer que pediu.
+    handleMonitoringDelta: reconstrói o estado completo a partir de um delta de monitoramento.
+    handleMonitoringBatch: processa, em ordem, várias mensagens de monitoramento enviadas juntas.
 */
+
+// Recursos opcionais do protocolo que o servidor entende; o broadcaster
+// anuncia os seus no registro e recebe a interseção no auth-success
+const SERVER_CAPABILITIES = ["monitoring-delta", "activity-spans", "monitoring-batch", "monitoring-deflate",
+                             "browser-history", "candidate-batch"];
+const MONITORING_STATE_FIELDS = ["foreground", "idle_seconds", "is_idle", "active_url"];
+// Folga entre o relógio de parede (timestamps) e o monotônico ("interval") ao
+// conferir que duas amostras são consecutivas
+const SAMPLE_CLOCK_TOLERANCE = 2;
+
+// Controle de admissão: registros completos (com autenticação no banco) por
+// segundo. Acima disso o broadcaster recebe um retry-after espalhado no tempo
+const REGISTRATION_RATE = parseInt(process.env.BROADCASTER_REGISTRATION_RATE) || 20;
+const MIN_RETRY_AFTER = 2;
+let registrationTokens = REGISTRATION_RATE;
+let lastRegistrationRefill = Date.now();
+let recentRejections = 0;
+
+function registrationRetryAfter() {
+    const now = Date.now();
+    const elapsed = (now - lastRegistrationRefill) / 1000;
+    registrationTokens = Math.min(REGISTRATION_RATE, registrationTokens + elapsed * REGISTRATION_RATE);
+    recentRejections = Math.max(0, recentRejections - elapsed * REGISTRATION_RATE);
+    lastRegistrationRefill = now;
+
+    if (registrationTokens >= 1) {
+        registrationTokens -= 1;
+        return 0;
+    }
+    // Espalha os recusados pelo tempo necessário para atender todos na taxa permitida
+    recentRejections += 1;
+    const window = Math.max(MIN_RETRY_AFTER, recentRejections / REGISTRATION_RATE);
+    return Math.ceil(MIN_RETRY_AFTER / 2 + Math.random() * window);
+}
+
+function negotiateCapabilities(msg) {
+    const requested = Array.isArray(msg.capabilities) ? msg.capabilities : [];
+    return requested.filter(capability => SERVER_CAPABILITIES.includes(capability));
+}
+
 async function registerBroadcaster(ws, id, msg, peers, broadcasters) {
     const peer = peers.get(id);
     peer.role = "broadcaster";
     peer.monitor_number = msg.monitor_number;
     peer.name = msg.broadcaster_name || msg.computer_name || `Broadcaster ${id.slice(0, 6)}`;
     peer.company_id = msg.company_id || "-1";
+    const capabilities = negotiateCapabilities(msg);
+    const session = msg.session_token ? takeSession(msg.session_token) : null;
 
     let db_id = null;
     let installation_id = null;
     let broadcaster_group_name = null;
-    
-    if (process.env.DATABASE_URL) {
+    let monitoringState = null;
+    let savedSession = null;
+
+    // O token de sessão carrega a identidade, então só sai depois da autenticação
+    const issueSessionToken = () => {
+        savedSession = saveSession({
+            db_id: db_id,
+            installation_id: installation_id,
+            broadcaster_group_name: broadcaster_group_name,
+            name: peer.name,
+            monitoringState: monitoringState,
+            // Retomada herda o instante da autenticação original
+            authenticatedAt: session ? session.authenticatedAt : undefined
+        });
+        return savedSession.token;
+    };
+
+    if (!session) {
+        const retryAfter = registrationRetryAfter();
+        if (retryAfter > 0) {
+            console.log(`⏳ Muitos registros simultâneos, broadcaster ${id} deve tentar em ${retryAfter}s`);
+            ws.send(JSON.stringify({ type: "retry-after", retry_after: retryAfter }));
+            ws.close(1013, "Servidor ocupado, tente novamente");
+            return;
+        }
+    }
+
+    if (session) {
+        // Retomada: identidade e estado de monitoramento vêm da sessão anterior
+        db_id = session.db_id;
+        installation_id = session.installation_id;
+        broadcaster_group_name = session.broadcaster_group_name;
+        peer.name = session.name;
+        monitoringState = session.monitoringState;
+
+        ws.send(JSON.stringify({
+            type: "auth-success",
+            resumed: true,
+            broadcaster_id: db_id,
+            installation_id: installation_id,
+            broadcaster_group_name: broadcaster_group_name,
+            computer_name: peer.name,
+            capabilities: capabilities,
+            session_token: issueSessionToken(),
+            monitoring_seq: monitoringState?.seq ?? null,
+            message: "Sessão retomada"
+        }));
+
+        if (installation_id && process.env.DATABASE_URL) {
+            // Retomada não consulta o banco, mas o último contato da instalação
+            // continua sendo registrado (sem atrasar o auth-success)
+            const broadcasterService = require('../services/broadcasterService');
+            broadcasterService.updateInstallationConnection(installation_id)
+                .catch(err => console.error('Erro ao registrar conexão da instalação:', err));
+        }
+
+        console.log(`⚡ Sessão retomada: ${peer.name} (Group ID: ${db_id}, Installation ID: ${installation_id}, seq ${monitoringState?.seq ?? '-'})`);
+    } else if (process.env.DATABASE_URL) {
         try {
             const db = require('../database/db');
             const broadcasterService = require('../services/broadcasterService');
@@ -39,6 +142,8 @@ async function registerBroadcaster(ws, id, msg, peers, broadcasters) {
                         installation_id: installation_id,
                         broadcaster_group_name: broadcaster_group_name,
                         computer_name: peer.name,
+                        capabilities: capabilities,
+                        session_token: issueSessionToken(),
                         message: `Reconexão bem-sucedida! Grupo: ${broadcaster_group_name}, Computer: ${peer.name}`
                     }));
                     
@@ -70,6 +175,8 @@ async function registerBroadcaster(ws, id, msg, peers, broadcasters) {
                             computer_name: computerName,
                             token: installation.jwt_token,
                             token_expires_at: installation.jwt_expires_at,
+                            capabilities: capabilities,
+                            session_token: issueSessionToken(),
                             message: `Installation registrada com sucesso! Grupo: ${broadcaster_group_name}, Computer: ${computerName}`
                         }));
                         
@@ -93,6 +200,8 @@ async function registerBroadcaster(ws, id, msg, peers, broadcasters) {
         }
     }
 
+    if (!savedSession) issueSessionToken();
+
     broadcasters.set(id, {
         ws,
         monitor_number: msg.monitor_number,
@@ -100,8 +209,22 @@ async function registerBroadcaster(ws, id, msg, peers, broadcasters) {
         company_id: peer.company_id,
         db_id: db_id,
         installation_id: installation_id,
-        broadcaster_group_name: broadcaster_group_name
+        broadcaster_group_name: broadcaster_group_name,
+        capabilities: capabilities,
+        monitoringState: monitoringState,
+        session: savedSession.session
     });
+    ws.broadcaster = broadcasters.get(id);
+
+    if (!session && !process.env.DATABASE_URL) {
+        // Sem banco não há autenticação, mas o broadcaster ainda precisa saber os recursos aceitos
+        ws.send(JSON.stringify({
+            type: "auth-success",
+            capabilities: capabilities,
+            session_token: savedSession.token,
+            message: "Registrado sem banco de dados"
+        }));
+    }
 
     console.log(`✅ Broadcaster conectado: ${peer.name} do grupo "${broadcaster_group_name}" (Monitor ${msg.monitor_number}, Group ID: ${db_id}, Installation ID: ${installation_id})`);
 
@@ -181,11 +304,27 @@ async function registerViewer(ws, id, peers, broadcasters) {
     }));
 }
 async function handleDisconnect(ws, id, peers, broadcasters, deletePeer) {
+    // O close registrado em createPeer pode já ter tirado o broadcaster do mapa;
+    // a referência no ws ainda guarda as amostras pendentes
+    if (ws.broadcaster) await flushPendingSamples(id, ws.broadcaster);
+
     const peer = peers.get(id);
     if (!peer) return;
 
     console.log(`❌ Peer desconectado: ${id} (${peer.role})`);
 
+    if (peer.role === "viewer" && peer.snapshotBroadcasters) {
+        for (const broadcasterId of peer.snapshotBroadcasters) {
+            const broadcasterData = broadcasters.get(broadcasterId);
+            if (broadcasterData && broadcasterData.ws.readyState === WebSocket.OPEN) {
+                broadcasterData.ws.send(JSON.stringify({
+                    type: "snapshot-unsubscribe",
+                    viewerId: id,
+                }));
+            }
+        }
+    }
+
     if (peer.role === "broadcaster") {
         const broadcasterData = broadcasters.get(id);
         const db_id = broadcasterData?.db_id;
@@ -241,6 +380,14 @@ function relayMessage(id, msg, peers) {//relayMessage(id, msg, peers)
         }));
     }
 }
+// Candidatos ICE juntados pelo broadcaster seguem um a um para o viewer
+function relayCandidates(id, msg, peers) {
+    const candidates = Array.isArray(msg.candidates) ? msg.candidates : [];
+    for (const candidate of candidates) {
+        relayMessage(id, { type: "candidate", targetId: msg.targetId, candidate }, peers);
+    }
+}
+
 async function handleWatch(ws, id, msg, peers, broadcasters) {
     const broadcasterId = msg.targetId;
     const monitor = msg.monitor_number || 1;
@@ -277,6 +424,10 @@ async function handleWatch(ws, id, msg, peers, broadcasters) {
             type: "new-viewer",
             viewerId: id,
             monitor_number: monitor,
+            max_width: msg.max_width,
+            max_height: msg.max_height,
+            max_fps: msg.max_fps,
+            region: msg.region,
         }));
 
         ws.send(JSON.stringify({
@@ -287,6 +438,69 @@ async function handleWatch(ws, id, msg, peers, broadcasters) {
     }
 }
 
+async function handleSnapshotRequest(ws, id, msg, peers, broadcasters) {
+    const broadcasterId = msg.targetId;
+    if (!broadcasters.has(broadcasterId)) return;
+    const { ws: bws, db_id } = broadcasters.get(broadcasterId);
+
+    const viewerId = ws.user?.id;
+    if (msg.type !== "snapshot-unsubscribe" && viewerId && db_id && process.env.DATABASE_URL) {
+        try {
+            const broadcasterService = require('../services/broadcasterService');
+            const hasPermission = await broadcasterService.hasViewerPermission(db_id, viewerId);
+            if (!hasPermission) {
+                console.log(`🚫 Viewer ${viewerId} pediu snapshots do broadcaster ${db_id} sem permissão`);
+                ws.send(JSON.stringify({
+                    type: "error",
+                    message: "Você não tem permissão para assistir este broadcaster"
+                }));
+                return;
+            }
+        } catch (err) {
+            console.error('Erro ao verificar permissão:', err);
+        }
+    }
+
+    const viewer = peers.get(id);
+    if (viewer) {
+        viewer.snapshotBroadcasters = viewer.snapshotBroadcasters || new Set();
+        if (msg.type === "snapshot-subscribe") {
+            viewer.snapshotBroadcasters.add(broadcasterId);
+        } else if (msg.type === "snapshot-unsubscribe") {
+            viewer.snapshotBroadcasters.delete(broadcasterId);
+        }
+    }
+
+    if (bws.readyState === WebSocket.OPEN) {
+        bws.send(JSON.stringify({
+            type: msg.type,
+            viewerId: id,
+            monitor_number: msg.monitor_number || 1,
+            interval: msg.interval,
+            max_width: msg.max_width,
+            max_height: msg.max_height,
+        }));
+    }
+}
+
+function relaySnapshot(id, msg, peers) {
+    const targetPeer = peers.get(msg.targetId);
+    if (!targetPeer || targetPeer.role !== "viewer") return;
+
+    if (targetPeer.ws.readyState === WebSocket.OPEN) {
+        targetPeer.ws.send(JSON.stringify({
+            type: "snapshot",
+            senderId: id,
+            monitor_number: msg.monitor_number,
+            format: msg.format,
+            width: msg.width,
+            height: msg.height,
+            image: msg.image,
+            timestamp: msg.timestamp,
+        }));
+    }
+}
+
 //Relatórios:
 function handleClientData(ws, id, msg, peers) {
     const peer = peers.get(id);
@@ -313,6 +527,36 @@ async function handleMonitoring(broadcasterId, msg, peers, broadcasters) {
         return;
     }
 
+    // Amostras reenviadas do spool offline são só gravadas: não viram estado
+    // base para deltas nem são repassadas aos viewers como se fossem ao vivo
+    const replayed = msg.replayed === true;
+
+    // Estado base para os próximos deltas
+    if (!replayed) {
+        broadcaster.monitoringState = {
+            seq: msg.seq,
+            timestamp: msg.timestamp,
+            host: msg.host,
+            system: msg.system,
+            apps: msg.apps || [],
+            foreground: msg.foreground,
+            idle_seconds: msg.idle_seconds,
+            is_idle: msg.is_idle,
+            active_url: msg.active_url
+        };
+        if (broadcaster.session) {
+            broadcaster.session.monitoringState = broadcaster.monitoringState;
+            touchSession(broadcaster.session);
+        }
+    }
+
+    // Com "activity-spans" o broadcaster agrega as amostras em intervalos e
+    // só os intervalos fechados são gravados; as amostras seguem apenas ao vivo.
+    // Amostras do spool sem o campo (gravadas antes de o broadcaster agregar)
+    // viram registros avulsos para não se perderem
+    const hasSpans = Array.isArray(msg.activity_spans) || !replayed;
+    const spans = broadcaster.capabilities?.includes("activity-spans") && hasSpans ? (msg.activity_spans || []) : null;
+
     if (process.env.DATABASE_URL) {
         const databaseStorage = require('../services/databaseStorage');
         const broadcasterDbId = broadcaster.db_id;
@@ -324,40 +568,54 @@ async function handleMonitoring(broadcasterId, msg, peers, broadcasters) {
         }
         
         try {
-            await databaseStorage.saveActivity(broadcasterDbId, {
-                installation_id: installationId,
-                idle_seconds: parseInt(msg.idle_seconds) || 0,
-                active_url: msg.active_url,
-                foreground_app: msg.foreground?.app,
-                app_count: msg.apps ? msg.apps.length : 0,
-                apps: msg.apps
-            });
+            if (spans) {
+                for (const span of spans) {
+                    await databaseStorage.saveActivity(broadcasterDbId, {
+                        installation_id: installationId,
+                        timestamp: span.start,
+                        ended_at: span.end,
+                        duration_seconds: Math.round(span.duration) || 0,
+                        idle_seconds: parseInt(span.idle_seconds) || 0,
+                        active_url: span.active_url,
+                        foreground_app: span.foreground?.app,
+                        app_count: span.apps ? span.apps.length : 0,
+                        apps: span.apps
+                    });
+                }
+            } else {
+                const sample = takePendingSample(broadcaster, msg, replayed);
+                if (sample) await saveSampleActivity(broadcasterId, broadcaster, sample);
+            }
         } catch (err) {
             console.error('Erro ao salvar atividade no banco:', err);
         }
 
-        if (msg.browser_history && msg.browser_history.length > 0) {
-            console.log(`📚 Salvando ${msg.browser_history.length} entradas de histórico de navegação`);
-            try {
-                await databaseStorage.saveBrowserHistory(broadcasterDbId, installationId, msg.browser_history);
-            } catch (err) {
-                console.error('Erro ao salvar histórico de navegação no banco:', err);
-            }
-        }
+        await saveBrowserHistory(broadcasterId, broadcaster, msg.browser_history);
     } else {
-        const { addActivity, addBrowserHistory } = require('../services/activityStorage');
-        addActivity(broadcasterId, msg).catch(err => {
-            console.error('Erro ao salvar atividade:', err);
-        });
-
-        if (msg.browser_history && msg.browser_history.length > 0) {
-            console.log(`📚 Salvando ${msg.browser_history.length} entradas de histórico de navegação`);
-            addBrowserHistory(broadcasterId, msg.browser_history).catch(err => {
-                console.error('Erro ao salvar histórico de navegação:', err);
+        const { addActivity } = require('../services/activityStorage');
+        const activities = spans ? spans.map(span => ({
+            timestamp: span.start,
+            ended_at: span.end,
+            duration_seconds: span.duration,
+            host: msg.host,
+            system: msg.system,
+            idle_seconds: span.idle_seconds,
+            is_idle: span.is_idle,
+            active_url: span.active_url,
+            foreground: span.foreground,
+            apps: span.apps
+        })) : [takePendingSample(broadcaster, msg, replayed)].filter(Boolean);
+        for (const activity of activities) {
+            addActivity(broadcasterId, activity).catch(err => {
+                console.error('Erro ao salvar atividade:', err);
             });
         }
+
+        await saveBrowserHistory(broadcasterId, broadcaster, msg.browser_history);
     }
 
+    if (replayed) return;
+
     let viewersNotified = 0;
     for (const [viewerId, vpeer] of peers) {
         if (vpeer.role === "viewer" && 
@@ -385,6 +643,162 @@ async function handleMonitoring(broadcasterId, msg, peers, broadcasters) {
     console.log(`✅ Dados enviados para ${viewersNotified} viewer(s)`);
 }
 
+// Sem intervalos agregados, cada amostra vira um registro cuja duração é o tempo
+// medido até a seguinte, que só chega no "interval" da próxima amostra. O
+// registro fica pendente até lá (ou até a desconexão, sem duração). Amostras do
+// spool têm pendência própria, já que chegam misturadas às ao vivo
+function takePendingSample(broadcaster, msg, replayed) {
+    const slot = replayed ? "pendingReplayedSample" : "pendingSample";
+    const previous = broadcaster[slot];
+    broadcaster[slot] = msg;
+    if (!previous) return null;
+    // O "interval" só vale para a anterior se não houve outra amostra entre elas
+    const elapsed = (Date.parse(msg.timestamp) - Date.parse(previous.timestamp)) / 1000;
+    const consecutive = msg.interval != null && Math.abs(elapsed - msg.interval) <= SAMPLE_CLOCK_TOLERANCE;
+    return { ...previous, duration_seconds: consecutive ? msg.interval : undefined };
+}
+
+async function flushPendingSamples(broadcasterId, broadcaster) {
+    for (const slot of ["pendingSample", "pendingReplayedSample"]) {
+        const sample = broadcaster[slot];
+        broadcaster[slot] = null;
+        if (!sample) continue;
+        if (process.env.DATABASE_URL) {
+            await saveSampleActivity(broadcasterId, broadcaster, sample);
+        } else {
+            const { addActivity } = require('../services/activityStorage');
+            addActivity(broadcasterId, sample).catch(err => {
+                console.error('Erro ao salvar atividade:', err);
+            });
+        }
+    }
+}
+
+async function saveSampleActivity(broadcasterId, broadcaster, sample) {
+    if (!broadcaster.db_id) return;
+    const databaseStorage = require('../services/databaseStorage');
+    try {
+        // Gravado uma amostra depois: o horário é o da própria amostra, não o de chegada
+        await databaseStorage.saveActivity(broadcaster.db_id, {
+            installation_id: broadcaster.installation_id,
+            timestamp: sample.timestamp,
+            duration_seconds: sample.duration_seconds != null ? Math.round(sample.duration_seconds) : undefined,
+            idle_seconds: parseInt(sample.idle_seconds) || 0,
+            active_url: sample.active_url,
+            foreground_app: sample.foreground?.app,
+            app_count: sample.apps ? sample.apps.length : 0,
+            apps: sample.apps
+        });
+    } catch (err) {
+        console.error(`Erro ao salvar atividade de ${broadcasterId} no banco:`, err);
+    }
+}
+
+async function saveBrowserHistory(broadcasterId, broadcaster, entries) {
+    if (!entries || entries.length === 0) return;
+    console.log(`📚 Salvando ${entries.length} entradas de histórico de navegação`);
+
+    if (process.env.DATABASE_URL) {
+        const databaseStorage = require('../services/databaseStorage');
+        try {
+            await databaseStorage.saveBrowserHistory(broadcaster.db_id, broadcaster.installation_id, entries);
+        } catch (err) {
+            console.error('Erro ao salvar histórico de navegação no banco:', err);
+        }
+    } else {
+        const { addBrowserHistory } = require('../services/activityStorage');
+        addBrowserHistory(broadcasterId, entries).catch(err => {
+            console.error('Erro ao salvar histórico de navegação:', err);
+        });
+    }
+}
+
+// Com "browser-history" o histórico chega em mensagens próprias, fora da sequência dos deltas
+async function handleBrowserHistory(broadcasterId, msg, broadcasters) {
+    const broadcaster = broadcasters.get(broadcasterId);
+    if (!broadcaster) {
+        console.log(`⚠️ Broadcaster ${broadcasterId} não encontrado`);
+        return;
+    }
+    if (process.env.DATABASE_URL && !broadcaster.db_id) {
+        console.warn(`⚠️ Broadcaster ${broadcasterId} sem db_id - histórico de navegação não será salvo.`);
+        return;
+    }
+    await saveBrowserHistory(broadcasterId, broadcaster, msg.entries);
+}
+
+async function handleMonitoringDelta(ws, broadcasterId, msg, peers, broadcasters) {
+    const broadcaster = broadcasters.get(broadcasterId);
+    if (!broadcaster) {
+        console.log(`⚠️ Broadcaster ${broadcasterId} não encontrado`);
+        return;
+    }
+
+    const state = broadcaster.monitoringState;
+    if (!state || msg.seq !== state.seq + 1) {
+        // Sem estado base ou delta fora de ordem: descarta e pede um keyframe
+        console.log(`🔁 Delta de monitoramento sem base de ${broadcasterId} (seq ${msg.seq}), pedindo keyframe`);
+        broadcaster.monitoringState = null;
+        if (ws.readyState === WebSocket.OPEN) {
+            ws.send(JSON.stringify({ type: "monitoring-keyframe-request" }));
+        }
+        await saveRejectedDelta(broadcasterId, broadcaster, state, msg, peers, broadcasters);
+        return;
+    }
+
+    const closed = new Set(msg.apps_closed || []);
+    const fullMsg = {
+        ...state,
+        type: "monitoring",
+        seq: msg.seq,
+        timestamp: msg.timestamp,
+        interval: msg.interval,
+        apps: state.apps
+            .filter(app => !closed.has(`${app.pid}|${app.title}`))
+            .concat(msg.apps_opened || []),
+        browser_history: msg.browser_history || [],
+        activity_spans: msg.activity_spans || []
+    };
+    for (const field of MONITORING_STATE_FIELDS) {
+        if (field in msg) fullMsg[field] = msg[field];
+    }
+
+    await handleMonitoring(broadcasterId, fullMsg, peers, broadcasters);
+}
+
+// Intervalos fechados e histórico não dependem do estado base: um delta
+// recusado (ex.: o anterior foi descartado no congestionamento) ainda os grava.
+// O broadcaster não os reenvia, só o que não chegou a sair vai para o spool
+async function saveRejectedDelta(broadcasterId, broadcaster, state, msg, peers, broadcasters) {
+    const spans = msg.activity_spans || [];
+    if (spans.length > 0 && broadcaster.capabilities?.includes("activity-spans")) {
+        await handleMonitoring(broadcasterId, {
+            type: "monitoring",
+            replayed: true,
+            timestamp: msg.timestamp,
+            host: msg.host ?? state?.host,
+            system: msg.system ?? state?.system,
+            activity_spans: spans,
+            browser_history: msg.browser_history || []
+        }, peers, broadcasters);
+    } else {
+        await saveBrowserHistory(broadcasterId, broadcaster, msg.browser_history);
+    }
+}
+
+async function handleMonitoringBatch(ws, broadcasterId, msg, peers, broadcasters) {
+    const messages = Array.isArray(msg.messages) ? msg.messages : [];
+    for (const item of messages) {
+        if (item.type === "monitoring") {
+            await handleMonitoring(broadcasterId, item, peers, broadcasters);
+        } else if (item.type === "monitoring-delta") {
+            await handleMonitoringDelta(ws, broadcasterId, item, peers, broadcasters);
+        } else if (item.type === "browser-history") {
+            await handleBrowserHistory(broadcasterId, item, broadcasters);
+        }
+    }
+}
+
 async function handleTokenRenewal(ws, broadcasterId, broadcasters) {
     const broadcaster = broadcasters.get(broadcasterId);
     if (!broadcaster || !broadcaster.db_id) {
@@ -438,10 +852,16 @@ async function handleTokenRenewal(ws, broadcasterId, broadcasters) {
 module.exports = { 
     registerViewer,
     handleWatch,
+    handleSnapshotRequest,
+    relaySnapshot,
     relayMessage,
+    relayCandidates,
     registerBroadcaster,
     handleDisconnect,
     handleClientData,
     handleMonitoring,
+    handleMonitoringDelta,
+    handleMonitoringBatch,
+    handleBrowserHistory,
     handleTokenRenewal
 };
@@ -1,26 +1,66 @@
 import asyncio
+import base64
+import fractions
 import json
-import mss
-import cv2
-import numpy as np
+import gc
+import math
+import multiprocessing
 import websockets
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from aiortc.sdp import candidate_from_sdp
-from av import VideoFrame
+import websockets.exceptions
 import platform
 import psutil
+import queue
+import random
+import threading
 import time
-from datetime import datetime, timedelta
+import zlib
+from collections import deque
+from datetime import datetime, timedelta, timezone
 import sqlite3
 import os
 import shutil
-import tempfile
 from pathlib import Path
 
 nome_computador = platform.node()
 sistema_operacional = platform.system()
 
 CONFIG_FILE = Path.home() / '.simplificavideos' / 'broadcaster_config.json'
+HISTORY_STATE_FILE = CONFIG_FILE.parent / 'history_state.json'
+HISTORY_SCRATCH_DIR = CONFIG_FILE.parent / 'history_scratch'
+SPOOL_FILE = CONFIG_FILE.parent / 'monitoring_spool.db'
+# Visitas lidas por navegador a cada coleta; o restante fica para as próximas
+HISTORY_READ_LIMIT = 1000
+
+# Ajustes de vídeo; podem ser sobrescritos pela seção "video" do broadcaster_config.json
+DEFAULT_VIDEO_CONFIG = {
+    'fps': 30,
+    'capture_mode': 'thread',
+    'capture_layout': 'auto',
+    'combined_min_coverage': 0.75,
+    'idle_fps': 1,
+    'user_idle_fps': 0.2,
+    'static_timeout': 1.0,
+    'codec_preferences': None,
+    'max_bitrate': None,
+    'keyframe_interval': None,
+    'snapshot_interval': 5,
+    'snapshot_min_interval': 2,
+    'snapshot_max_width': 320,
+    'snapshot_format': 'jpeg',
+    'snapshot_quality': 60,
+}
+
+# Ritmo da coleta de monitoramento; pode ser sobrescrito pela seção "monitoring"
+# do broadcaster_config.json
+DEFAULT_MONITORING_CONFIG = {
+    'interval': 2,
+    'min_interval': 1,
+    'max_interval': 10,
+    'idle_max_interval': 60,
+    'backoff': 1.5,
+    'burst_samples': 3,
+    'idle_poll_interval': 2,
+}
 
 
 def load_broadcaster_config():
@@ -71,6 +111,12 @@ def save_broadcaster_config(broadcaster_id, token, token_expires_at, server_url=
         elif existing_config.get('server_url'):
             config['server_url'] = existing_config['server_url']
         
+        # Preserva ajustes de vídeo definidos manualmente
+        if existing_config.get('video'):
+            config['video'] = existing_config['video']
+        if existing_config.get('monitoring'):
+            config['monitoring'] = existing_config['monitoring']
+        
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=2)
         
@@ -83,12 +129,98 @@ def save_broadcaster_config(broadcaster_id, token, token_expires_at, server_url=
         return False
 
 
-def get_browser_history(hours_back=24):
+def load_history_state():
+    """Carrega as marcas d'água do histórico (última visita já enviada por navegador)"""
+    if not HISTORY_STATE_FILE.exists():
+        return {}
+
+    try:
+        with open(HISTORY_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Erro ao ler estado do histórico: {e}")
+        return {}
+
+
+def save_history_state(state):
+    """Persiste as marcas d'água do histórico para não reenviar visitas após reiniciar"""
+    try:
+        HISTORY_STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with open(HISTORY_STATE_FILE, 'w') as f:
+            json.dump(state, f, indent=2)
+        return True
+    except Exception as e:
+        print(f"❌ Erro ao salvar estado do histórico: {e}")
+        return False
+
+
+def history_db_fingerprint(path):
+    """Tamanho e mtime do banco e do WAL; muda sempre que o navegador grava algo"""
+    fingerprint = []
+    for file_path in (path, path + '-wal'):
+        try:
+            stat = os.stat(file_path)
+            fingerprint.append([stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def open_history_db(name, path):
+    """
+    Abre o banco de histórico de um navegador sem copiá-lo quando possível.
+
+    1. Somente leitura direto no arquivo original.
+    2. Se o navegador segura o lock e não há WAL pendente, abre como
+       'immutable' (ignora locks).
+    3. Caso contrário copia só o banco e o WAL para uma pasta de trabalho
+       reaproveitada entre ciclos.
+
+    Retorna (conexão, modo usado).
+    """
+    uri = Path(path).resolve().as_uri()
+    wal_path = path + '-wal'
+    has_wal = os.path.exists(wal_path) and os.path.getsize(wal_path) > 0
+
+    attempts = [('somente leitura', f"{uri}?mode=ro")]
+    if not has_wal:
+        attempts.append(('imutável', f"{uri}?mode=ro&immutable=1"))
+
+    for open_mode, db_uri in attempts:
+        conn = None
+        try:
+            conn = sqlite3.connect(db_uri, uri=True, timeout=0)
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            return conn, open_mode
+        except sqlite3.Error:
+            if conn:
+                conn.close()
+
+    HISTORY_SCRATCH_DIR.mkdir(parents=True, exist_ok=True)
+    scratch_file = HISTORY_SCRATCH_DIR / f"{name}.db"
+    scratch_wal = HISTORY_SCRATCH_DIR / f"{name}.db-wal"
+    for stale in (scratch_wal, HISTORY_SCRATCH_DIR / f"{name}.db-shm"):
+        if stale.exists():
+            stale.unlink()
+    shutil.copyfile(path, scratch_file)
+    if has_wal:
+        shutil.copyfile(wal_path, scratch_wal)
+    return sqlite3.connect(str(scratch_file)), 'cópia'
+
+
+def get_browser_history(hours_back=24, watermarks=None):
     """
     Lê o histórico de navegação dos navegadores instalados.
-    Retorna lista de URLs visitadas nas últimas 'hours_back' horas.
+
+    Só retorna visitas mais novas que a marca d'água de cada navegador
+    (id da visita em 'visits' / 'moz_historyvisits'). Sem marca d'água,
+    faz a carga inicial das últimas 'hours_back' horas.
+
+    Retorna (entradas, novas_marcas). As marcas só devem ser persistidas
+    depois que as entradas forem entregues ao servidor.
     """
     history_entries = []
+    watermarks = dict(watermarks or {})
     cutoff_time = datetime.now() - timedelta(hours=hours_back)
     
     browser_paths = []
@@ -126,40 +258,59 @@ def get_browser_history(hours_back=24):
                         break
     
     for browser in browser_paths:
-        temp_file = None
+        conn = None
         try:
             if not os.path.exists(browser['path']):
                 continue
+
+            watermark = watermarks.get(browser['name'])
+            fingerprint = history_db_fingerprint(browser['path'])
+            if watermark and watermark.get('fingerprint') == fingerprint:
+                # Banco e WAL intactos desde a última leitura: nada novo
+                continue
             
-            temp_file = tempfile.mktemp(suffix='.db')
-            shutil.copy2(browser['path'], temp_file)
-            
-            conn = sqlite3.connect(temp_file)
+            conn, open_mode = open_history_db(browser['name'], browser['path'])
             cursor = conn.cursor()
             
             if browser['name'] == 'Firefox':
+                visits_table = 'moz_historyvisits'
                 query = """
-                    SELECT url, title, datetime(visit_date/1000000, 'unixepoch', 'localtime') as visit_time
+                    SELECT moz_historyvisits.id, visit_date, url, title,
+                           datetime(visit_date/1000000, 'unixepoch', 'localtime') as visit_time
                     FROM moz_places 
                     JOIN moz_historyvisits ON moz_places.id = moz_historyvisits.place_id
-                    WHERE visit_date/1000000 > ?
-                    ORDER BY visit_date DESC
-                    LIMIT 1000
+                    WHERE moz_historyvisits.id > ? AND visit_date/1000000 > ?
+                    ORDER BY moz_historyvisits.id ASC
+                    LIMIT ?
                 """
-                cursor.execute(query, (int(cutoff_time.timestamp()),))
             else:
+                visits_table = 'visits'
                 query = """
-                    SELECT url, title, datetime(last_visit_time/1000000-11644473600, 'unixepoch', 'localtime') as visit_time
+                    SELECT visits.id, visits.visit_time, urls.url, urls.title,
+                           datetime(visits.visit_time/1000000-11644473600, 'unixepoch', 'localtime') as visit_time
                     FROM urls 
-                    WHERE last_visit_time/1000000-11644473600 > ?
-                    ORDER BY last_visit_time DESC
-                    LIMIT 1000
+                    JOIN visits ON urls.id = visits.url
+                    WHERE visits.id > ? AND visits.visit_time/1000000-11644473600 > ?
+                    ORDER BY visits.id ASC
+                    LIMIT ?
                 """
-                cursor.execute(query, (int(cutoff_time.timestamp()),))
+
+            if watermark:
+                # Histórico apagado no navegador: os ids recomeçam, refaz a carga inicial
+                cursor.execute(f"SELECT MAX(id) FROM {visits_table}")
+                max_id = cursor.fetchone()[0] or 0
+                if max_id < watermark['last_id']:
+                    print(f"🔄 Histórico do {browser['name']} foi limpo, refazendo carga inicial")
+                    watermark = None
+
+            if watermark:
+                cursor.execute(query, (watermark['last_id'], 0, HISTORY_READ_LIMIT))
+            else:
+                cursor.execute(query, (0, int(cutoff_time.timestamp()), HISTORY_READ_LIMIT))
             
             rows = cursor.fetchall()
             for row in rows:
-                url, title, visit_time = row
+                visit_id, raw_visit_time, url, title, visit_time = row
                 try:
                     parsed_time = datetime.strptime(visit_time, '%Y-%m-%d %H:%M:%S')
                     iso_timestamp = parsed_time.isoformat()
@@ -172,31 +323,893 @@ def get_browser_history(hours_back=24):
                     'title': title or 'Sem título',
                     'timestamp': iso_timestamp
                 })
+
+            if rows:
+                visit_id, raw_visit_time = rows[-1][:2]
+                watermarks[browser['name']] = {
+                    'last_id': visit_id,
+                    'last_visit_time': raw_visit_time,
+                    # Leitura no limite: ainda há visitas, o banco precisa ser lido de novo
+                    'fingerprint': fingerprint if len(rows) < HISTORY_READ_LIMIT else None,
+                }
+            elif watermark:
+                watermarks[browser['name']] = {**watermark, 'fingerprint': fingerprint}
+            else:
+                watermarks.pop(browser['name'], None)
             
-            conn.close()
-            os.remove(temp_file)
-            
-            print(f"✅ {len(rows)} entradas do histórico do {browser['name']}")
+            print(f"✅ {len(rows)} entradas novas do histórico do {browser['name']} ({open_mode})")
             
         except Exception as e:
             print(f"⚠️ Erro ao ler histórico do {browser['name']}: {e}")
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
+        finally:
+            if conn:
+                conn.close()
     
     history_entries.sort(key=lambda x: x['timestamp'], reverse=True)
-    return history_entries
+    return history_entries, watermarks
+
+
+class ProcessInfoCache:
+    """
+    Nome de cada processo visto nas janelas, guardado com o create_time do
+    processo. Processos já conhecidos não custam nenhuma chamada ao sistema
+    por tick: refresh() faz uma única listagem de pids (psutil.pids) e
+    descarta quem saiu. Um pid que sai e é reaproveitado entre duas
+    listagens não aparece nelas, então cada entrada tem o create_time
+    conferido a cada REVALIDATE_INTERVAL segundos; se mudou, é outro
+    processo e o nome é lido de novo. Falhas (acesso negado, processo
+    encerrado) ficam em cache pelo mesmo intervalo e depois são repetidas.
+    """
+
+    REVALIDATE_INTERVAL = 30
 
+    def __init__(self):
+        self.processes = {}
+        self.lookups = 0
+
+    def refresh(self):
+        """Atualiza a lista de processos vivos; retorna os pids em ordem"""
+        pids = psutil.pids()
+        alive = set(pids)
+        for pid in [pid for pid in self.processes if pid not in alive]:
+            del self.processes[pid]
+        return pids
+
+    def name(self, pid):
+        """Nome do processo, ou None se não puder ser lido"""
+        now = time.monotonic()
+        entry = self.processes.get(pid)
+        if entry is not None and now - entry[2] >= self.REVALIDATE_INTERVAL:
+            entry = self._revalidate(pid, entry, now)
+        if entry is None:
+            self.lookups += 1
+            try:
+                process = psutil.Process(pid)
+                with process.oneshot():
+                    entry = (process.create_time(), process.name(), now)
+            except (psutil.Error, OSError):
+                entry = (None, None, now)
+            self.processes[pid] = entry
+        return entry[1]
+
+    def _revalidate(self, pid, entry, now):
+        """Mantém a entrada se o pid ainda é o mesmo processo; None para ler de novo"""
+        create_time, name, _ = entry
+        if create_time is None:
+            return None
+        self.lookups += 1
+        try:
+            if psutil.Process(pid).create_time() != create_time:
+                return None
+        except (psutil.Error, OSError):
+            return None
+        entry = (create_time, name, now)
+        self.processes[pid] = entry
+        return entry
+
+
+MONITORING_CAPABILITIES = ['monitoring-delta', 'activity-spans', 'monitoring-batch', 'monitoring-deflate',
+                           'browser-history', 'candidate-batch']
+# Histórico enviado à parte vai em pedaços, para não ocupar a conexão de uma vez
+HISTORY_CHUNK_SIZE = 200
+# Payloads de monitoramento a partir deste tamanho vão comprimidos (zlib) em frame binário
+MONITORING_COMPRESS_THRESHOLD = 1024
+MONITORING_COMPRESS_LEVEL = 6
+
+
+def encode_monitoring(message):
+    """JSON sem espaços: as mesmas chaves se repetem em cada app e em cada visita"""
+    return json.dumps(message, separators=(',', ':'))
+
+
+def pack_monitoring_payload(payload, compress):
+    """
+    Com 'monitoring-deflate' negociado, payloads grandes (keyframes, lotes,
+    histórico) viram bytes zlib, enviados como frame binário; os pequenos
+    (deltas) seguem como texto, onde a compressão mais custa do que economiza.
+    """
+    if compress and len(payload) >= MONITORING_COMPRESS_THRESHOLD:
+        return zlib.compress(payload.encode('utf-8'), MONITORING_COMPRESS_LEVEL)
+    return payload
+
+
+class MonitoringDeltaEncoder:
+    """
+    Codifica as amostras de monitoramento em keyframes (estado completo) e
+    deltas (só o que mudou desde a amostra anterior: apps abertos/fechados,
+    troca de primeiro plano, transições de ociosidade). Um keyframe sai a
+    cada KEYFRAME_INTERVAL segundos, na primeira amostra após reconectar e
+    sempre que o servidor pedir.
+    """
+
+    KEYFRAME_INTERVAL = 60
+    STATE_FIELDS = ('foreground', 'idle_seconds', 'is_idle', 'active_url')
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.reset()
+
+    def reset(self):
+        self.seq = 0
+        self.state = None
+        self.apps = {}
+        self.last_keyframe = 0
+
+    def request_keyframe(self):
+        self.state = None
+
+    @staticmethod
+    def app_key(app):
+        return f"{app.get('pid')}|{app.get('title')}"
+
+    def encode(self, sample):
+        """Recebe a amostra completa ("monitoring") e devolve a mensagem a enviar"""
+        self.seq += 1
+        now = time.monotonic()
+        apps = {self.app_key(app): app for app in sample['apps']}
+
+        if self.state is None or now - self.last_keyframe >= self.keyframe_interval:
+            message = {**sample, 'mode': 'keyframe', 'seq': self.seq}
+            self.last_keyframe = now
+        else:
+            message = {
+                'type': 'monitoring-delta',
+                'seq': self.seq,
+                'timestamp': sample['timestamp'],
+            }
+            if sample.get('interval') is not None:
+                message['interval'] = sample['interval']
+            opened = [app for key, app in apps.items() if key not in self.apps]
+            closed = [key for key in self.apps if key not in apps]
+            if opened:
+                message['apps_opened'] = opened
+            if closed:
+                message['apps_closed'] = closed
+            for field in self.STATE_FIELDS:
+                if sample[field] != self.state[field]:
+                    message[field] = sample[field]
+            for field in ('browser_history', 'activity_spans'):
+                if sample.get(field):
+                    message[field] = sample[field]
+
+        self.state = {field: sample[field] for field in self.STATE_FIELDS}
+        self.apps = apps
+        return message
+
+
+class ActivitySpanAggregator:
+    """
+    Junta amostras consecutivas com o mesmo estado (app e título em primeiro
+    plano, ociosidade e conjunto de janelas abertas) em um único intervalo
+    com início, fim e duração. O intervalo fecha quando o estado muda ou
+    quando atinge MAX_SPAN segundos, para que os relatórios não fiquem
+    esperando uma sessão longa terminar. Início e fim saem em UTC com fuso.
+    """
+
+    MAX_SPAN = 300
+    # Sem amostras por mais que isso (ex.: desconectado), o intervalo fecha na última amostra
+    GAP_TOLERANCE = 10
+
+    def __init__(self, max_span=MAX_SPAN, gap_tolerance=GAP_TOLERANCE):
+        self.max_span = max_span
+        self.gap_tolerance = gap_tolerance
+        self.span = None
+        self.span_key = None
+
+    @staticmethod
+    def state_key(sample):
+        foreground = sample['foreground'] or {}
+        apps = tuple(sorted(MonitoringDeltaEncoder.app_key(app) for app in sample['apps']))
+        return foreground.get('app'), foreground.get('title'), sample['is_idle'], apps
+
+    def add(self, sample, now=None):
+        """Registra uma amostra; retorna a lista de intervalos que fecharam"""
+        now = now or datetime.now(timezone.utc)
+        closed = []
+        key = self.state_key(sample)
+        if self.span and (now - self.span['last']).total_seconds() > self.gap_tolerance:
+            closed.append(self._close(self.span['last']))
+        if self.span and (key != self.span_key or
+                          (now - self.span['started']).total_seconds() >= self.max_span):
+            closed.append(self._close(now))
+        if self.span is None:
+            self.span_key = key
+            self.span = {
+                'started': now,
+                'foreground': sample['foreground'],
+                'apps': sample['apps'],
+                'is_idle': sample['is_idle'],
+                'idle_seconds': sample['idle_seconds'],
+                'active_url': sample['active_url'],
+                'samples': 0,
+            }
+        self.span['idle_seconds'] = max(self.span['idle_seconds'], sample['idle_seconds'])
+        self.span['active_url'] = sample['active_url'] or self.span['active_url']
+        self.span['samples'] += 1
+        self.span['last'] = now
+        return closed
+
+    def flush(self, now=None):
+        """Fecha o intervalo aberto (ex.: ao encerrar); retorna lista vazia se não houver"""
+        if self.span is None:
+            return []
+        return [self._close(now or datetime.now(timezone.utc))]
+
+    def _close(self, now):
+        span, self.span, self.span_key = self.span, None, None
+        started = span.pop('started')
+        span.pop('last')
+        return {
+            **span,
+            'start': started.isoformat(),
+            'end': now.isoformat(),
+            'duration': round((now - started).total_seconds(), 1),
+        }
+
+
+class SamplingScheduler:
+    """
+    Decide quanto esperar até a próxima amostra de monitoramento. Logo após
+    uma troca de janela, de conjunto de apps ou de ociosidade amostra a cada
+    min_interval por burst_samples amostras; depois volta a interval e vai
+    espaçando (multiplicando por backoff) enquanto nada muda, até max_interval
+    com o usuário ativo ou idle_max_interval com ele ocioso. Esses tetos são
+    o atraso máximo com que uma mudança aparece.
+    """
+
+    def __init__(self, config):
+        self.interval = config['interval']
+        self.min_interval = config['min_interval']
+        self.max_interval = config['max_interval']
+        self.idle_max_interval = config['idle_max_interval']
+        self.backoff = config['backoff']
+        self.burst_samples = config['burst_samples']
+        self.current = self.interval
+        self.burst_left = 0
+
+    def next_interval(self, changed, is_idle):
+        if changed:
+            self.burst_left = self.burst_samples
+            self.current = self.interval
+        if self.burst_left > 0:
+            self.burst_left -= 1
+            return self.min_interval
+        limit = self.idle_max_interval if is_idle else self.max_interval
+        interval = min(self.current, limit)
+        self.current = min(self.current * self.backoff, limit)
+        return interval
+
+
+class MonitoringBatcher:
+    """
+    Acumula mensagens de monitoramento já serializadas e as envia juntas em
+    uma única "monitoring-batch" quando o lote passa de MAX_BYTES, chega a
+    MAX_MESSAGES ou a mensagem mais antiga espera há MAX_LATENCY segundos.
+    Mensagens urgentes esvaziam o lote na hora (na ordem em que chegaram).
+    """
+
+    MAX_BYTES = 16384
+    MAX_MESSAGES = 15
+    MAX_LATENCY = 10
+
+    def __init__(self, max_bytes=MAX_BYTES, max_messages=MAX_MESSAGES, max_latency=MAX_LATENCY):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_latency = max_latency
+        self.reset()
+
+    def reset(self):
+        self.pending = []
+        self.pending_bytes = 0
+        self.oldest = None
+
+    def add(self, payload, urgent=False):
+        """Enfileira uma mensagem; retorna o lote a enviar agora ou None"""
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        self.pending.append(payload)
+        self.pending_bytes += len(payload)
+        if (urgent or self.pending_bytes >= self.max_bytes or
+                len(self.pending) >= self.max_messages or
+                time.monotonic() - self.oldest >= self.max_latency):
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.pending:
+            return None
+        if len(self.pending) == 1:
+            payload = self.pending[0]
+        else:
+            payload = '{"type":"monitoring-batch","messages":[' + ','.join(self.pending) + ']}'
+        self.reset()
+        return payload
+
+
+class MonitoringSpool:
+    """
+    Fila em disco (SQLite, só inserção no fim) para as amostras produzidas
+    enquanto o broadcaster está sem conexão. O tamanho é limitado a
+    MAX_BYTES; passando disso, as amostras mais antigas são descartadas.
+    """
+
+    MAX_BYTES = 50 * 1024 * 1024
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES):
+        self.path = Path(path or SPOOL_FILE)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)")
+        self.conn.commit()
+        self.total_bytes, self.count = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(payload)), 0), COUNT(*) FROM spool").fetchone()
+
+    def append(self, payload):
+        self.conn.execute("INSERT INTO spool (payload) VALUES (?)", (payload,))
+        self.total_bytes += len(payload)
+        self.count += 1
+        evicted = 0
+        while self.total_bytes > self.max_bytes and self.count > 1:
+            row = self.conn.execute("SELECT id, LENGTH(payload) FROM spool ORDER BY id LIMIT 1").fetchone()
+            self.conn.execute("DELETE FROM spool WHERE id = ?", (row[0],))
+            self.total_bytes -= row[1]
+            self.count -= 1
+            evicted += 1
+        self.conn.commit()
+        if evicted:
+            print(f"⚠️ Spool cheio: {evicted} amostra(s) mais antiga(s) descartada(s)")
+
+    def peek(self, limit):
+        """Amostras mais antigas primeiro: [(id, payload), ...]"""
+        return self.conn.execute("SELECT id, payload FROM spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def remove_through(self, last_id):
+        removed_bytes, removed = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(payload)), 0), COUNT(*) FROM spool WHERE id <= ?", (last_id,)).fetchone()
+        self.conn.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+        self.conn.commit()
+        self.total_bytes -= removed_bytes
+        self.count -= removed
+
+    def close(self):
+        self.conn.close()
+
+
+class OutboundQueue:
+    """
+    Fila única de saída do WebSocket de sinalização: um só escritor envia as
+    mensagens por prioridade (sinalização > monitoramento > histórico) e, em
+    cada prioridade, na ordem de chegada. Candidatos ICE ainda na fila para
+    o mesmo viewer saem juntos numa mensagem só; mensagens com a mesma chave
+    (ex.: snapshot de um viewer) são substituídas pela mais nova.
+
+    Sinalização sai sempre na hora. As demais só começam a sair com o buffer
+    de escrita do transporte abaixo de BUFFER_LIMIT, para nunca atrasarem um
+    offer. Se o que está pendente passar de MAX_PENDING_BYTES, as mensagens
+    descartáveis mais antigas (menor prioridade primeiro) saem da fila e vão
+    para o seu on_drop (ex.: spool em disco).
+    """
 
-class ScreenCaptureTrack(VideoStreamTrack):
+    SIGNALING = 0
+    MONITORING = 1
+    HISTORY = 2
+    BUFFER_LIMIT = 16384
+    MAX_PENDING_BYTES = 256 * 1024
+    DRAIN_POLL = 0.05
 
-    def __init__(self, monitor_number=1, fps=30):
-        super().__init__()
-        self.sct = mss.mss()
+    def __init__(self, socket, buffer_limit=BUFFER_LIMIT, max_pending_bytes=MAX_PENDING_BYTES):
+        self.socket = socket
+        self.buffer_limit = buffer_limit
+        self.max_pending_bytes = max_pending_bytes
+        self.candidate_batch = False
+        self.queues = [deque() for _ in range(self.HISTORY + 1)]
+        self.candidates = {}
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.closed = False
+        self.sending = None
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, payload, priority, key=None, droppable=False, on_drop=None, future=None):
+        """Enfileira sem esperar o envio"""
+        item = {'payload': payload, 'priority': priority, 'key': key, 'droppable': droppable,
+                'on_drop': on_drop, 'future': future,
+                'size': len(payload) if priority != self.SIGNALING else 0}
+        if self.closed:
+            self._drop(item)
+            return
+        queue = self.queues[priority]
+        if key is not None:
+            for queued in queue:
+                if queued['key'] == key:
+                    queue.remove(queued)
+                    self.pending_bytes -= queued['size']
+                    break
+        queue.append(item)
+        self.pending_bytes += item['size']
+        self._trim()
+        self.wakeup.set()
+
+    async def send(self, payload, priority):
+        """Enfileira e espera: True se saiu, False se foi descartada ou a conexão caiu"""
+        future = asyncio.get_running_loop().create_future()
+        self.put(payload, priority, future=future)
+        return await future
+
+    def put_candidate(self, viewer_id, candidate):
+        """Junta o candidato aos que ainda esperam na fila para o mesmo viewer"""
+        if self.closed:
+            # Conexão caída: o escritor não roda mais e o candidato não teria destino
+            self.dropped += 1
+            return
+        queue = self.queues[self.SIGNALING]
+        item = self.candidates.get(viewer_id)
+        if item is None:
+            item = {'payload': None, 'priority': self.SIGNALING, 'key': None, 'droppable': False,
+                    'on_drop': None, 'future': None, 'size': 0,
+                    'viewer_id': viewer_id, 'candidates': []}
+            self.candidates[viewer_id] = item
+        else:
+            # Vai para o fim da fila, depois de um offer enfileirado nesse meio tempo
+            queue.remove(item)
+        item['candidates'].append(candidate)
+        queue.append(item)
+        self.wakeup.set()
+
+    def buffer_size(self):
+        transport = getattr(self.socket, 'transport', None)
+        return transport.get_write_buffer_size() if transport else 0
+
+    def close(self):
+        """Descarta o que ficou na fila (cada item vai para o seu on_drop)"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        if self.sending:
+            self._drop(self.sending)
+            self.sending = None
+        for queue in self.queues:
+            while queue:
+                self._drop(queue.popleft())
+        self.candidates.clear()
+
+    def _payloads(self, item):
+        if 'candidates' not in item:
+            return [item['payload']]
+        self.candidates.pop(item['viewer_id'], None)
+        if self.candidate_batch and len(item['candidates']) > 1:
+            return [json.dumps({"type": "candidates", "candidates": item['candidates'],
+                                "targetId": item['viewer_id']})]
+        return [json.dumps({"type": "candidate", "candidate": candidate, "targetId": item['viewer_id']})
+                for candidate in item['candidates']]
+
+    def _pop(self):
+        for priority, queue in enumerate(self.queues):
+            if not queue:
+                continue
+            if priority != self.SIGNALING and self.buffer_size() > self.buffer_limit:
+                return None
+            item = queue.popleft()
+            self.pending_bytes -= item['size']
+            return item
+        return None
+
+    def _trim(self):
+        while self.pending_bytes > self.max_pending_bytes:
+            victim = None
+            for queue in reversed(self.queues):
+                victim = next((item for item in queue if item['droppable']), None)
+                if victim:
+                    queue.remove(victim)
+                    break
+            if victim is None:
+                return
+            self.pending_bytes -= victim['size']
+            self._drop(victim)
+            print(f"⚠️ Conexão congestionada: mensagem de prioridade {victim['priority']} retirada da fila "
+                  f"({self.dropped} até agora)")
+
+    def _drop(self, item):
+        self.dropped += 1
+        if item['on_drop']:
+            try:
+                item['on_drop']()
+            except Exception as e:
+                print(f"❌ Erro ao tratar mensagem descartada: {e}")
+        if item['future'] and not item['future'].done():
+            item['future'].set_result(False)
+
+    async def _run(self):
+        try:
+            while True:
+                self.wakeup.clear()
+                item = self._pop()
+                if item is None:
+                    if any(self.queues):
+                        # Esperando o buffer esvaziar; sinalização nova acorda antes
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), self.DRAIN_POLL)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self.wakeup.wait()
+                    continue
+                self.sending = item
+                try:
+                    for payload in self._payloads(item):
+                        await self.socket.send(payload)
+                except websockets.exceptions.ConnectionClosed:
+                    raise
+                except Exception as e:
+                    # Uma mensagem com problema não derruba o escritor: só ela se perde
+                    self.sending = None
+                    print(f"❌ Erro ao enviar mensagem de prioridade {item['priority']}: {e}")
+                    if item['future'] and not item['future'].done():
+                        item['future'].set_result(False)
+                    continue
+                self.sending = None
+                if item['future'] and not item['future'].done():
+                    item['future'].set_result(True)
+        except asyncio.CancelledError:
+            pass
+        except websockets.exceptions.ConnectionClosed:
+            self.close()
+
+
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+# Pilha de vídeo: a maioria dos hosts roda dias só com monitoramento, então
+# mss, OpenCV, numpy, aiortc e PyAV só são importados no primeiro snapshot
+# (load_capture_stack) ou no primeiro viewer (load_video_stack)
+mss = cv2 = np = None
+RTCPeerConnection = RTCRtpSender = RTCSessionDescription = VideoStreamTrack = None
+h264 = vpx = candidate_from_sdp = VideoFrame = None
+# Definido por load_video_stack() (ver define_screen_capture_track)
+ScreenCaptureTrack = None
+
+# Limites originais de bitrate dos encoders do aiortc (min, padrão, máx)
+ENCODER_BITRATE_DEFAULTS = {}
+
+
+def load_capture_stack():
+    """Importa o necessário para capturar a tela (mss, OpenCV, numpy)"""
+    global mss, cv2, np
+    if np is not None:
+        return
+    import mss
+    import cv2
+    import numpy as np
+
+
+def load_video_stack():
+    """Importa a pilha completa de vídeo na primeira chamada; as seguintes não fazem nada"""
+    global RTCPeerConnection, RTCRtpSender, RTCSessionDescription, VideoStreamTrack
+    global h264, vpx, candidate_from_sdp, VideoFrame, ScreenCaptureTrack
+    if VideoStreamTrack is not None:
+        return
+    load_capture_stack()
+    from aiortc import RTCPeerConnection, RTCRtpSender, RTCSessionDescription, VideoStreamTrack
+    from aiortc.codecs import h264, vpx
+    from aiortc.sdp import candidate_from_sdp
+    from av import VideoFrame
+    ENCODER_BITRATE_DEFAULTS.update({
+        codec_module: (codec_module.MIN_BITRATE, codec_module.DEFAULT_BITRATE, codec_module.MAX_BITRATE)
+        for codec_module in (h264, vpx)
+    })
+    ScreenCaptureTrack = define_screen_capture_track(VideoStreamTrack)
+
+
+def apply_encoder_settings(video_config):
+    """
+    Aplica max_bitrate aos encoders H.264 e VP8 do aiortc. Os limites são
+    constantes de módulo, então valem para todas as conexões do processo.
+    """
+    max_bitrate = video_config.get('max_bitrate')
+    for codec_module, (min_bitrate, default_bitrate, default_max) in ENCODER_BITRATE_DEFAULTS.items():
+        if max_bitrate:
+            codec_module.MIN_BITRATE = min(min_bitrate, max_bitrate)
+            codec_module.DEFAULT_BITRATE = min(default_bitrate, max_bitrate)
+            codec_module.MAX_BITRATE = max_bitrate
+        else:
+            codec_module.MIN_BITRATE = min_bitrate
+            codec_module.DEFAULT_BITRATE = default_bitrate
+            codec_module.MAX_BITRATE = default_max
+
+
+def order_codec_preferences(preferred_names):
+    """Codecs de vídeo do aiortc com os preferidos (ex: ['H264', 'VP8']) primeiro"""
+    capabilities = RTCRtpSender.getCapabilities("video").codecs
+    ordered = []
+    for name in preferred_names:
+        mime_type = f"video/{name}".lower()
+        ordered += [codec for codec in capabilities
+                    if codec.mimeType.lower() == mime_type and codec not in ordered]
+    # Mantém os demais (incluindo rtx) para a negociação não falhar
+    ordered += [codec for codec in capabilities if codec not in ordered]
+    return ordered
+
+
+class FramePacer:
+    """
+    Agenda frames em deadlines do relógio (início + n * intervalo) em vez de
+    dormir um intervalo inteiro depois de cada captura, então o tempo de
+    grab não reduz a taxa real. Se a captura atrasar mais de um intervalo,
+    os frames perdidos são descartados (não acumulados), mantendo a latência
+    limitada. Acumula fps alcançado, jitter e frames descartados por janela.
+    """
+
+    # Atrasos abaixo disso não compensam dormir
+    MIN_SLEEP = 0.001
+
+    def __init__(self, fps):
+        self.interval = 1 / fps
+        self.deadline = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.window_start = time.monotonic()
+        self.frames = 0
+        self.published = 0
+        self.dropped = 0
+        self.jitter_total = 0.0
+
+    def set_interval(self, interval):
+        """Muda o intervalo alvo; o agendamento é reancorado no instante atual"""
+        if interval != self.interval:
+            self.interval = interval
+            self.deadline = None
+
+    def delay(self):
+        """Segundos até o próximo deadline (0 se já chegou)"""
+        now = time.monotonic()
+        if self.deadline is None:
+            # Alinha à grade do relógio: engines com a mesma taxa capturam nos
+            # mesmos instantes e podem dividir o grab da tela virtual
+            self.deadline = math.ceil(now / self.interval) * self.interval
+        remaining = self.deadline - now
+        return remaining if remaining >= self.MIN_SLEEP else 0
+
+    def tick(self):
+        """Registra o início de um frame e retorna o deadline (monotonic) que ele representa"""
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        missed = int((now - self.deadline) // self.interval)
+        if missed > 0:
+            self.dropped += missed
+        target = self.deadline + max(missed, 0) * self.interval
+        self.jitter_total += abs(now - target)
+        self.frames += 1
+        self.deadline = target + self.interval
+        return target
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.window_start, 1e-6)
+        return {
+            'fps': self.frames / elapsed,
+            'published_fps': self.published / elapsed,
+            'jitter_ms': self.jitter_total / self.frames * 1000 if self.frames else 0.0,
+            'dropped': self.dropped,
+        }
+
+
+class VirtualScreenGrabber:
+    """
+    Captura combinada: um único grab da tela virtual (monitors[0]) por
+    instante, compartilhado entre os engines de todos os monitores. Cada
+    engine recebe o seu monitor como um recorte (view numpy, sem cópia).
+    Cada thread chama grab() com a sua própria instância do mss.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bgra = None
+        self.origin = (0, 0)
+        self.grabbed_at = None
+
+    def grab(self, sct, monitor, timestamp, tolerance):
+        """Recorte de monitor do grab do instante timestamp (reaproveitado se dentro da tolerância)"""
+        with self.lock:
+            if self.grabbed_at is None or abs(timestamp - self.grabbed_at) > tolerance:
+                virtual = sct.monitors[0]
+                shot = sct.grab(virtual)
+                self.bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+                self.origin = (virtual['left'], virtual['top'])
+                self.grabbed_at = timestamp
+            bgra = self.bgra
+        x = monitor['left'] - self.origin[0]
+        y = monitor['top'] - self.origin[1]
+        return bgra[y:y + monitor['height'], x:x + monitor['width']]
+
+
+class CaptureRung:
+    """
+    Degrau da escada de resolução/fps de um ScreenCaptureEngine. Cada frame
+    é reduzido e convertido uma única vez por degrau e compartilhado por
+    todos os viewers inscritos nele.
+
+    scale_divisor: a resolução é a nativa dividida por este valor
+    fps_divisor: a taxa é o fps do engine dividido por este valor
+    """
+
+    def __init__(self, scale_divisor, fps_divisor, pool_size):
+        self.scale_divisor = scale_divisor
+        self.fps_divisor = fps_divisor
+        self.subscribers = set()
+        self.frame = None
+        self.frame_id = 0
+        self.frame_event = asyncio.Event()
+        self.pool_size = pool_size
+        self.frame_pool = []
+        self.frame_pool_index = 0
+        self.scaled_buffer = None
+        self.next_due = None
+
+    @property
+    def key(self):
+        return self.scale_divisor, self.fps_divisor
+
+    def size_for(self, width, height):
+        """Resolução do degrau para um grab width x height (pares, exigência do yuv420p)"""
+        return (width // self.scale_divisor) & ~1, (height // self.scale_divisor) & ~1
+
+    def is_due(self, timestamp, interval):
+        """Verifica se o degrau deve receber o frame do instante timestamp"""
+        if self.next_due is not None and timestamp < self.next_due - interval / 2:
+            return False
+        if self.next_due is None or timestamp - self.next_due >= interval:
+            self.next_due = timestamp
+        self.next_due += interval
+        return True
+
+    def _next_yuv_buffer(self, width, height):
+        """Próximo buffer I420 do anel; recria o anel se a resolução mudar"""
+        shape = (height * 3 // 2, width)
+        if not self.frame_pool or self.frame_pool[0].shape != shape:
+            self.frame_pool = [np.empty(shape, dtype=np.uint8) for _ in range(self.pool_size)]
+            self.frame_pool_index = 0
+        buffer = self.frame_pool[self.frame_pool_index]
+        self.frame_pool_index = (self.frame_pool_index + 1) % self.pool_size
+        return buffer
+
+    def convert_yuv(self, bgra, dst=None):
+        """Reduz (se preciso) e converte o grab BGRA para I420 em dst (ou no próximo buffer do anel)"""
+        width, height = self.size_for(bgra.shape[1], bgra.shape[0])
+        if self.scale_divisor == 1:
+            source = bgra[:height, :width]
+        else:
+            if self.scaled_buffer is None or self.scaled_buffer.shape[:2] != (height, width):
+                self.scaled_buffer = np.empty((height, width, 4), dtype=np.uint8)
+            source = cv2.resize(bgra, (width, height), dst=self.scaled_buffer,
+                                interpolation=cv2.INTER_AREA)
+        if dst is None:
+            dst = self._next_yuv_buffer(width, height)
+        return cv2.cvtColor(source, cv2.COLOR_BGRA2YUV_I420, dst=dst)
+
+    def convert(self, bgra):
+        """Reduz (se preciso) e converte o grab BGRA para um VideoFrame yuv420p"""
+        return VideoFrame.from_numpy_buffer(self.convert_yuv(bgra), format='yuv420p')
+
+    def copy_frame(self, yuv):
+        """VideoFrame com uma cópia de um frame I420 já convertido (ex.: vindo de outro processo)"""
+        buffer = self._next_yuv_buffer(yuv.shape[1], yuv.shape[0] * 2 // 3)
+        np.copyto(buffer, yuv)
+        return VideoFrame.from_numpy_buffer(buffer, format='yuv420p')
+
+    def publish(self, frame):
+        self.frame = frame
+        self.frame_id += 1
+        self.wake()
+
+    def wake(self):
+        """Acorda quem espera neste degrau (frame novo ou track trocando de degrau)"""
+        event, self.frame_event = self.frame_event, asyncio.Event()
+        event.set()
+
+
+class ScreenCaptureEngine:
+    """
+    Captura um monitor uma única vez por frame e entrega o mesmo frame
+    para todos os tracks inscritos, independente do número de viewers.
+
+    capture_mode:
+        'thread': grab e conversão rodam numa thread dedicada que produz
+                  frames numa fila limitada; o event loop só publica o frame.
+        'inline': grab e conversão rodam no próprio event loop (modo antigo).
+        'process': grab e conversão rodam num processo separado por monitor
+                   (CaptureProcessWorker), que escreve os frames I420 num
+                   anel em memória compartilhada; o processo principal só
+                   copia o frame, codifica e faz a sinalização. Não usa a
+                   captura combinada da tela virtual.
+
+    O buffer BGRA do mss é lido sem cópia e convertido numa única passada
+    para yuv420p (formato do encoder) dentro de buffers pré-alocados,
+    reutilizados em anel; os VideoFrames apenas apontam para esses buffers.
+
+    Viewers pedem resolução/fps máximos e são agrupados em degraus
+    (CaptureRung) de uma escada fixa, para que pedidos parecidos dividam a
+    mesma redução. O engine captura na maior taxa entre os degraus ativos.
+
+    Uma amostra em grade de cada grab é comparada com a anterior: frames
+    iguais não são convertidos nem publicados. Após static_timeout segundos
+    sem mudança a captura cai para idle_fps (ou user_idle_fps se idle_probe
+    indicar usuário ocioso), publicando um frame de manutenção a cada grab,
+    e volta à taxa cheia assim que algo muda ou o usuário volta a usar a máquina.
+
+    region (ver parse_capture_region) restringe o grab a um retângulo do
+    monitor ou à janela em primeiro plano ('foreground'), reavaliada a cada
+    REGION_POLL_INTERVAL segundos para acompanhar a janela quando ela é
+    movida, redimensionada ou trocada. capture_rect é o retângulo
+    efetivamente capturado (o monitor inteiro sem região).
+    """
+
+    CHANGE_SAMPLE_STEP = 4
+    IDLE_POLL_INTERVAL = 0.25
+    REGION_POLL_INTERVAL = 0.5
+    STATS_INTERVAL = 30
+    SCALE_LADDER = (1, 2, 3, 4, 6, 8)
+    FPS_LADDER = (1, 2, 3, 6, 15, 30)
+
+    def __init__(self, monitor_number=1, fps=30, capture_mode='thread', queue_size=2,
+                 idle_fps=1, user_idle_fps=0.2, static_timeout=1.0,
+                 idle_probe=None, idle_threshold=60, region=None):
+        self.sct = self._open_screen()
         self.monitor_number = int(monitor_number)
+        self.region = region
+        self.region_checked = 0
         self.fps = fps
+        self.capture_mode = capture_mode
+        self.idle_fps = idle_fps
+        self.user_idle_fps = user_idle_fps
+        self.static_timeout = static_timeout
+        self.idle_probe = idle_probe
+        self.idle_threshold = idle_threshold
+        self.last_sample = None
+        self.last_change_time = time.monotonic()
+        self.rungs = {}
+        self.capture_fps = fps
+        # Definido pelo Broadcaster quando a captura combinada compensa
+        self.shared_grabber = None
+        self.has_published = False
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        # Frames na fila + publicado + ainda em encode + o que está sendo escrito
+        self.frame_pool_size = queue_size + 3
+        self.capture_task = None
+        self.capture_thread = None
+        self.stop_event = None
+        self.process = None
+        self.process_conn = None
+        self.process_rings = {}
+        self.process_worker = CaptureProcessWorker
+        self.start_time = None
+        self.pacer = FramePacer(fps)
         self.update_monitor()
 
     def update_monitor(self):
@@ -204,18 +1217,784 @@ class ScreenCaptureTrack(VideoStreamTrack):
         if self.monitor_number <= 0 or self.monitor_number > total_monitors:
             self.monitor_number = 1
         self.monitor = self.sct.monitors[self.monitor_number]
-        print(f"🖥️ Capturando monitor {self.monitor_number}: {self.monitor}")
+        self.capture_rect = self._region_rect()
+        print(f"🖥️ Capturando monitor {self.monitor_number}: {self.monitor}"
+              + (f" — região {self.region}: {self.capture_rect}" if self.region else ""))
+
+    def _region_rect(self):
+        """Retângulo a capturar: a região recortada ao monitor, ou o monitor inteiro"""
+        rect = None
+        if self.region == 'foreground':
+            bounds = get_foreground_bounds()
+            if bounds:
+                rect = clip_capture_rect(self.monitor, *bounds)
+        elif self.region:
+            x, y, width, height = self.region
+            rect = clip_capture_rect(self.monitor, self.monitor['left'] + x,
+                                     self.monitor['top'] + y, width, height)
+        return rect or self.monitor
+
+    def _follow_region(self):
+        """No modo 'foreground', acompanha a janela em primeiro plano"""
+        if self.region != 'foreground':
+            return
+        now = time.monotonic()
+        if now - self.region_checked < self.REGION_POLL_INTERVAL:
+            return
+        self.region_checked = now
+        rect = self._region_rect()
+        if rect != self.capture_rect:
+            self.capture_rect = rect
+            # O conteúdo da janela pode ser o mesmo: força a taxa cheia no novo recorte
+            self.last_change_time = now
+
+    @property
+    def running(self):
+        return (self.capture_task is not None or self.capture_thread is not None or
+                self.process is not None)
+
+    @property
+    def current_fps(self):
+        """Taxa de grab atual (cai para idle_fps/user_idle_fps com a tela parada)"""
+        if self.process or not self.pacer.interval:
+            return self.capture_fps
+        return 1 / self.pacer.interval
+
+    @property
+    def subscribers(self):
+        return {track for rung in self.rungs.values() for track in rung.subscribers}
+
+    def select_rung(self, max_width=None, max_height=None, max_fps=None):
+        """Menor redução da escada que cabe em max_width x max_height, e maior fps <= max_fps"""
+        scale_divisor = self.SCALE_LADDER[-1]
+        for divisor in self.SCALE_LADDER:
+            width = self.capture_rect['width'] // divisor
+            height = self.capture_rect['height'] // divisor
+            if (not max_width or width <= max_width) and (not max_height or height <= max_height):
+                scale_divisor = divisor
+                break
+
+        fps_divisor = self.FPS_LADDER[-1]
+        for divisor in self.FPS_LADDER:
+            if not max_fps or self.fps / divisor <= max_fps:
+                fps_divisor = divisor
+                break
+        return scale_divisor, fps_divisor
+
+    def attach(self, track, rung_key):
+        """Inscreve um track num degrau; inicia a captura se for o primeiro"""
+        rung = self.rungs.get(rung_key)
+        if rung is None:
+            rung = CaptureRung(*rung_key, pool_size=self.frame_pool_size)
+            self.rungs[rung_key] = rung
+            width, height = rung.size_for(self.capture_rect['width'], self.capture_rect['height'])
+            print(f"🪜 Monitor {self.monitor_number}: novo degrau {width}x{height} @ "
+                  f"{self.fps / rung.fps_divisor:g} fps")
+        rung.subscribers.add(track)
+        self._update_capture_fps()
+        # Novo viewer: taxa cheia até a tela ficar estática de novo
+        self.last_change_time = time.monotonic()
+        if not self.running:
+            self.start()
+        elif self.process:
+            self._sync_process_rungs()
+        print(f"🔗 Monitor {self.monitor_number}: {len(self.subscribers)} track(s) inscritos "
+              f"em {len(self.rungs)} degrau(s)")
+        return rung
+
+    def detach(self, track, rung):
+        """Remove um track; encerra a captura quando não restar nenhum"""
+        rung.subscribers.discard(track)
+        if not rung.subscribers:
+            self.rungs.pop(rung.key, None)
+        self._update_capture_fps()
+        if not self.rungs:
+            self.stop()
+        elif self.process:
+            self._sync_process_rungs()
+
+    def _update_capture_fps(self):
+        """A captura acompanha o degrau mais rápido em uso"""
+        if self.rungs:
+            self.capture_fps = self.fps / min(rung.fps_divisor for rung in self.rungs.values())
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.pacer = FramePacer(self.capture_fps)
+        if self.capture_mode == 'process':
+            self._start_process()
+        elif self.capture_mode == 'thread':
+            self.stop_event = threading.Event()
+            self.capture_thread = threading.Thread(
+                target=self._capture_worker,
+                args=(asyncio.get_running_loop(), self.stop_event),
+                name=f"captura-monitor-{self.monitor_number}",
+                daemon=True)
+            self.capture_thread.start()
+        else:
+            self.capture_task = asyncio.create_task(self._capture_loop())
+
+    def stop(self):
+        if not self.running:
+            return
+        if self.capture_task:
+            self.capture_task.cancel()
+            self.capture_task = None
+        if self.stop_event:
+            # A thread encerra sozinha após o grab atual; não bloqueia o event loop com join
+            self.stop_event.set()
+            self.stop_event = None
+            self.capture_thread = None
+        if self.process:
+            # O processo encerra sozinho; o leitor termina quando o pipe fechar
+            try:
+                self.process_conn.send(('stop',))
+            except OSError:
+                pass
+            self.process = None
+            self._release_process_rings()
+        print(f"⏹️ Captura do monitor {self.monitor_number} encerrada")
+
+    def close(self):
+        self.stop()
+        self.sct.close()
+
+    def _open_screen(self):
+        return mss.mss()
+
+    def _start_process(self):
+        # spawn em todos os sistemas: fork com threads vivas não é seguro
+        context = multiprocessing.get_context('spawn')
+        self.process_conn, child_conn = context.Pipe()
+        settings = {
+            'monitor_number': self.monitor_number,
+            'fps': self.fps,
+            'idle_fps': self.idle_fps,
+            'user_idle_fps': self.user_idle_fps,
+            'static_timeout': self.static_timeout,
+            'idle_threshold': self.idle_threshold,
+            'region': self.region,
+        }
+        self.process = context.Process(
+            target=run_capture_process, args=(self.process_worker, child_conn, settings),
+            name=f"captura-monitor-{self.monitor_number}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.process_rings = {}
+        self._sync_process_rungs()
+        threading.Thread(
+            target=self._process_reader,
+            args=(asyncio.get_running_loop(), self.process, self.process_conn, self.process_rings),
+            name=f"leitor-captura-{self.monitor_number}", daemon=True).start()
+
+    def _sync_process_rungs(self):
+        """Cria um anel em memória compartilhada por degrau novo e avisa o processo de captura"""
+        try:
+            for key, rung in self.rungs.items():
+                if key in self.process_rings:
+                    continue
+                # A janela em primeiro plano muda de tamanho: slots comportam o monitor inteiro
+                bounds = self.monitor if self.region == 'foreground' else self.capture_rect
+                width, height = rung.size_for(bounds['width'], bounds['height'])
+                ring = SharedFrameRing(width, height, self.frame_pool_size)
+                self.process_rings[key] = ring
+                self.process_conn.send(('rung', key, ring.name, width, height, ring.slots))
+            for key in [key for key in self.process_rings if key not in self.rungs]:
+                self.process_conn.send(('drop', key))
+                self.process_rings.pop(key).close()
+        except OSError as e:
+            print(f"⚠️ Processo de captura do monitor {self.monitor_number} indisponível: {e}")
+
+    def _release_process_rings(self):
+        for ring in self.process_rings.values():
+            ring.close()
+        self.process_rings = {}
+
+    def _process_reader(self, loop, process, conn, rings):
+        """Thread que recebe os avisos de frame do processo de captura"""
+        try:
+            while True:
+                frames = conn.recv()
+                loop.call_soon_threadsafe(self._publish_process_frames, rings, frames)
+        except (EOFError, OSError):
+            pass
+        except RuntimeError:
+            # Event loop encerrado
+            return
+        conn.close()
+        try:
+            loop.call_soon_threadsafe(self._process_exited, process)
+        except RuntimeError:
+            pass
+
+    def _publish_process_frames(self, rings, frames):
+        published = []
+        for key, slot, pts, width, height in frames:
+            rung = self.rungs.get(key)
+            ring = rings.get(key)
+            if rung is None or ring is None or ring.closed:
+                continue
+            # Cópia local: o slot volta a ser escrito enquanto o encoder ainda usa o frame
+            frame = rung.copy_frame(ring.frame(slot, width, height))
+            frame.pts = pts
+            frame.time_base = VIDEO_TIME_BASE
+            published.append((rung, frame))
+        if published:
+            self._publish(published)
+
+    def _process_exited(self, process):
+        if process is not self.process:
+            return
+        # Encerrou sem ter sido parado (ex.: erro no processo): segue em thread
+        print(f"❌ Processo de captura do monitor {self.monitor_number} encerrou; "
+              f"voltando para captura em thread")
+        self.process = None
+        self._release_process_rings()
+        self.capture_mode = 'thread'
+        if self.rungs:
+            self.start()
+
+    def _grab_bgra(self, sct, timestamp):
+        """Retorna o grab como array BGRA apontando para o buffer do mss (sem cópia)"""
+        rect = self.capture_rect
+        grabber = self.shared_grabber
+        if grabber:
+            return grabber.grab(sct, rect, timestamp, self.pacer.interval / 2)
+        shot = sct.grab(rect)
+        return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+    def _has_changed(self, bgra):
+        """Compara uma amostra em grade do grab com a amostra anterior"""
+        step = self.CHANGE_SAMPLE_STEP
+        sample = bgra[::step, ::step]
+        if self.last_sample is None or self.last_sample.shape != sample.shape:
+            self.last_sample = sample.copy()
+            return True
+        if np.array_equal(sample, self.last_sample):
+            return False
+        np.copyto(self.last_sample, sample)
+        return True
+
+    def _user_idle_seconds(self):
+        return self.idle_probe() if self.idle_probe else 0
 
-    async def recv(self):
-        pts, time_base = await self.next_timestamp()
-        img = np.array(self.sct.grab(self.monitor))
-        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
-        frame = VideoFrame.from_ndarray(img, format='bgr24')
+    def _capture_interval(self):
+        """Intervalo até o próximo grab conforme atividade da tela e do usuário"""
+        if time.monotonic() - self.last_change_time < self.static_timeout:
+            return 1 / self.capture_fps
+        if self._user_idle_seconds() > self.idle_threshold:
+            return 1 / min(self.user_idle_fps, self.capture_fps)
+        return 1 / min(self.idle_fps, self.capture_fps)
+
+    def _grab_frames(self, sct, timestamp, keepalive=False):
+        """
+        Captura um frame e converte para cada degrau que o deve receber,
+        com pts no instante agendado (monotonic). Retorna [(degrau, frame)],
+        vazio se a tela não mudou, exceto em grabs de manutenção (keepalive),
+        que sempre publicam em todos os degraus.
+        """
+        bgra = self._grab_bgra(sct, timestamp)
+        if self._has_changed(bgra):
+            self.last_change_time = time.monotonic()
+        elif not keepalive and self.has_published:
+            return []
+
+        frames = []
+        pts = int((timestamp - self.start_time) * VIDEO_CLOCK_RATE)
+        for rung in list(self.rungs.values()):
+            if not keepalive and not rung.is_due(timestamp, rung.fps_divisor / self.fps):
+                continue
+            frames.append((rung, self._make_frame(rung, bgra, pts)))
+        return frames
+
+    def _make_frame(self, rung, bgra, pts):
+        frame = rung.convert(bgra)
         frame.pts = pts
-        frame.time_base = time_base
-        await asyncio.sleep(1 / self.fps)
+        frame.time_base = VIDEO_TIME_BASE
         return frame
 
+    def _publish(self, frames):
+        for rung, frame in frames:
+            rung.publish(frame)
+        self.has_published = True
+
+    def _next_grab(self, sct):
+        """Faz o grab do deadline atual; chamar só quando pacer.delay() for 0"""
+        self._follow_region()
+        keepalive = self.pacer.interval > 1 / self.capture_fps
+        frames = self._grab_frames(sct, self.pacer.tick(), keepalive=keepalive)
+        if frames:
+            self.pacer.published += 1
+        if time.monotonic() - self.pacer.window_start >= self.STATS_INTERVAL:
+            stats = self.pacer.stats()
+            print(f"📈 Monitor {self.monitor_number}: {stats['fps']:.1f} fps capturados, "
+                  f"{stats['published_fps']:.1f} publicados, jitter {stats['jitter_ms']:.1f}ms, "
+                  f"{stats['dropped']} frame(s) descartados")
+            self.pacer.reset_stats()
+        return frames
+
+    async def _capture_loop(self):
+        try:
+            while self.rungs:
+                self.pacer.set_interval(self._capture_interval())
+                delay = self.pacer.delay()
+                if delay:
+                    # Reavalia o intervalo ao acordar: o usuário pode ter voltado
+                    await self._sleep_next_grab(delay)
+                    continue
+                frames = self._next_grab(self.sct)
+                if frames:
+                    self._publish(frames)
+                # Devolve o controle ao event loop mesmo quando já está atrasado
+                await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"❌ Erro na captura do monitor {self.monitor_number}: {e}")
+            self.capture_task = None
+
+    def _user_returned(self, previous_idle_seconds):
+        """Verifica se o contador de ociosidade zerou (houve input) desde a última leitura"""
+        idle_seconds = self._user_idle_seconds()
+        if idle_seconds < previous_idle_seconds:
+            self.last_change_time = time.monotonic()
+            return True, idle_seconds
+        return False, idle_seconds
+
+    async def _sleep_next_grab(self, interval):
+        """Versão do _wait_next_grab para o modo inline"""
+        if interval <= self.IDLE_POLL_INTERVAL:
+            await asyncio.sleep(interval)
+            return
+        deadline = time.monotonic() + interval
+        idle_seconds = self._user_idle_seconds()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, self.IDLE_POLL_INTERVAL))
+            returned, idle_seconds = self._user_returned(idle_seconds)
+            if returned:
+                return
+
+    def _wait_next_grab(self, stop_event, interval):
+        """
+        Espera até o próximo grab. Em intervalos longos acorda antes se o
+        usuário voltar a usar o computador.
+        """
+        if interval <= self.IDLE_POLL_INTERVAL:
+            stop_event.wait(interval)
+            return
+        deadline = time.monotonic() + interval
+        idle_seconds = self._user_idle_seconds()
+        while not stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or stop_event.wait(min(remaining, self.IDLE_POLL_INTERVAL)):
+                return
+            returned, idle_seconds = self._user_returned(idle_seconds)
+            if returned:
+                return
+
+    def _capture_worker(self, loop, stop_event):
+        """Thread de captura: produz frames na fila e avisa o event loop"""
+        # Instâncias do mss não podem ser compartilhadas entre threads
+        sct = self._open_screen()
+        try:
+            while not stop_event.is_set():
+                self.pacer.set_interval(self._capture_interval())
+                delay = self.pacer.delay()
+                if delay:
+                    self._wait_next_grab(stop_event, delay)
+                    continue
+                frames = self._next_grab(sct)
+                if frames:
+                    try:
+                        self.frame_queue.put_nowait(frames)
+                    except queue.Full:
+                        # Viewers só precisam do frame mais recente: descarta o mais antigo
+                        try:
+                            self.frame_queue.get_nowait()
+                        except queue.Empty:
+                            pass
+                        self.frame_queue.put_nowait(frames)
+                    loop.call_soon_threadsafe(self._drain_frame_queue)
+        except RuntimeError:
+            # Event loop encerrado
+            pass
+        except Exception as e:
+            print(f"❌ Erro na thread de captura do monitor {self.monitor_number}: {e}")
+        finally:
+            sct.close()
+
+    def _drain_frame_queue(self):
+        # Degraus de fps diferentes recebem frames em grabs diferentes:
+        # publica o mais recente de cada degrau
+        latest = {}
+        while True:
+            try:
+                frames = self.frame_queue.get_nowait()
+            except queue.Empty:
+                break
+            for rung, frame in frames:
+                latest[rung] = frame
+        if latest:
+            self._publish(latest.items())
+
+
+class SharedFrameRing:
+    """
+    Anel de frames I420 de um degrau em multiprocessing.shared_memory.
+    O processo principal cria (e remove) o anel; o processo de captura o
+    abre pelo nome e escreve cada frame convertido no próximo slot.
+    width x height é a capacidade de cada slot: frames menores (região da
+    janela em primeiro plano, que muda de tamanho) também cabem.
+    """
+
+    def __init__(self, width, height, slots, name=None):
+        from multiprocessing import shared_memory
+        self.width = width
+        self.height = height
+        self.slots = slots
+        self.owner = name is None
+        self.frame_size = width * height * 3 // 2
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.frame_size * slots)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.index = 0
+        self.closed = False
+
+    def frame(self, slot, width, height):
+        """View I420 width x height do slot (sem cópia); soltar antes de close()"""
+        return np.ndarray((height * 3 // 2, width), dtype=np.uint8, buffer=self.shm.buf,
+                          offset=slot * self.frame_size)
+
+    def next_slot(self):
+        slot = self.index
+        self.index = (self.index + 1) % self.slots
+        return slot
+
+    def close(self):
+        self.closed = True
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class CaptureProcessWorker(ScreenCaptureEngine):
+    """
+    Lado do processo de captura no modo 'process': o mesmo laço do engine
+    (ritmo, detecção de mudança, degraus), mas cada frame é convertido
+    direto no anel em memória compartilhada do degrau e só (degrau, slot,
+    pts, largura, altura) volta pelo pipe. Mensagens do processo principal: ('rung', ...),
+    ('drop', key) e ('stop',).
+    """
+
+    def __init__(self, conn, **settings):
+        load_capture_stack()
+        super().__init__(capture_mode='process', idle_probe=get_idle_seconds, **settings)
+        self.conn = conn
+        self.rings = {}
+
+    def run(self):
+        self.start_time = time.monotonic()
+        self.pacer = FramePacer(self.capture_fps)
+        try:
+            while self._handle_messages():
+                if not self.rungs:
+                    self.conn.poll(None)
+                    continue
+                self.pacer.set_interval(self._capture_interval())
+                delay = self.pacer.delay()
+                if delay:
+                    # O próprio worker faz o papel do stop_event: mensagem nova acorda
+                    self._wait_next_grab(self, delay)
+                    continue
+                frames = self._next_grab(self.sct)
+                if frames:
+                    self.conn.send([(rung.key, *frame) for rung, frame in frames])
+        except (EOFError, OSError, KeyboardInterrupt):
+            # Processo principal encerrou
+            pass
+        finally:
+            for ring in self.rings.values():
+                ring.close()
+            self.sct.close()
+
+    def is_set(self):
+        return self.conn.poll()
+
+    def wait(self, timeout):
+        return self.conn.poll(timeout)
+
+    def _handle_messages(self):
+        """Aplica as mensagens pendentes; retorna False ao receber ('stop',)"""
+        while self.conn.poll():
+            message = self.conn.recv()
+            if message[0] == 'stop':
+                return False
+            if message[0] == 'rung':
+                _, key, name, width, height, slots = message
+                rung = CaptureRung(*key, pool_size=slots)
+                self.rings[key] = SharedFrameRing(width, height, slots, name=name)
+                self.rungs[key] = rung
+                self.last_change_time = time.monotonic()
+            elif message[0] == 'drop':
+                self.rungs.pop(message[1], None)
+                ring = self.rings.pop(message[1], None)
+                if ring:
+                    ring.close()
+            self._update_capture_fps()
+        return True
+
+    def _make_frame(self, rung, bgra, pts):
+        ring = self.rings[rung.key]
+        slot = ring.next_slot()
+        width, height = rung.size_for(bgra.shape[1], bgra.shape[0])
+        rung.convert_yuv(bgra, dst=ring.frame(slot, width, height))
+        return slot, pts, width, height
+
+
+def run_capture_process(worker_class, conn, settings):
+    """Ponto de entrada do processo de captura (precisa ser de módulo para o spawn)"""
+    worker_class(conn, **settings).run()
+
+
+def define_screen_capture_track(base):
+    """
+    Cria a classe do track de vídeo sobre o VideoStreamTrack do aiortc.
+    Chamada por load_video_stack(): a base só existe depois da importação.
+    """
+
+    class ScreenCaptureTrack(base):
+        """
+        Track de um viewer, alimentado por um degrau do ScreenCaptureEngine do
+        monitor. Com keyframe_interval, pede um keyframe ao sender (definido
+        após addTrack) a cada keyframe_interval segundos.
+        """
+
+        def __init__(self, engine, max_width=None, max_height=None, max_fps=None,
+                     keyframe_interval=None):
+            super().__init__()
+            self.engine = engine
+            self.last_frame_id = 0
+            self.sender = None
+            self.keyframe_interval = keyframe_interval
+            self.last_keyframe_time = time.monotonic()
+            self.requested_rung = engine.select_rung(max_width, max_height, max_fps)
+            self.rung = engine.attach(self, self.requested_rung)
+
+        async def recv(self):
+            frame = await self._next_frame()
+            if self.keyframe_interval and self.sender:
+                now = time.monotonic()
+                if now - self.last_keyframe_time >= self.keyframe_interval:
+                    # O sender codifica este frame logo após o recv retornar
+                    self.sender._send_keyframe()
+                    self.last_keyframe_time = now
+            return frame
+
+        async def _next_frame(self):
+            """
+            Aguarda um frame mais novo que last_frame_id. Relê self.rung a cada
+            volta: um switch_rung durante a espera acorda o degrau antigo, que
+            pode nem receber mais frames.
+            """
+            while self.rung.frame_id == self.last_frame_id:
+                await self.rung.frame_event.wait()
+            self.last_frame_id = self.rung.frame_id
+            return self.rung.frame
+
+        def switch_rung(self, rung_key):
+            """Move o track para outro degrau sem interromper a captura"""
+            if rung_key == self.rung.key:
+                return
+            old_rung = self.rung
+            # Inscreve no novo antes de sair do antigo para o engine não parar
+            self.rung = self.engine.attach(self, rung_key)
+            self.last_frame_id = 0
+            self.engine.detach(self, old_rung)
+            old_rung.wake()
+
+        def stop(self):
+            super().stop()
+            self.engine.detach(self, self.rung)
+
+    return ScreenCaptureTrack
+
+
+class ViewerQuality:
+    """
+    Controle de congestionamento de um viewer a partir das estatísticas RTCP
+    (remote-inbound-rtp). Perda ou RTT subindo rebaixam o viewer um nível;
+    após RECOVER_POLLS leituras boas seguidas ele sobe um nível. Cada nível
+    desce um degrau de fps ou de resolução, alternadamente, a partir do
+    degrau pedido pelo viewer.
+    """
+
+    MAX_LEVEL = 6
+    LOSS_DEGRADE = 0.05
+    LOSS_RECOVER = 0.01
+    RTT_DEGRADE_FACTOR = 2.0
+    RTT_DEGRADE_MARGIN = 0.2
+    RECOVER_POLLS = 5
+
+    def __init__(self):
+        self.level = 0
+        self.good_polls = 0
+        self.baseline_rtt = None
+
+    def update(self, fraction_lost, rtt):
+        """Atualiza o nível com uma leitura; retorna True se o nível mudou"""
+        if rtt is not None:
+            self.baseline_rtt = rtt if self.baseline_rtt is None else min(self.baseline_rtt, rtt)
+        rtt_rising = (rtt is not None and self.baseline_rtt is not None and
+                      rtt > max(self.baseline_rtt * self.RTT_DEGRADE_FACTOR,
+                                self.baseline_rtt + self.RTT_DEGRADE_MARGIN))
+
+        if fraction_lost > self.LOSS_DEGRADE or rtt_rising:
+            self.good_polls = 0
+            if self.level < self.MAX_LEVEL:
+                self.level += 1
+                return True
+            return False
+
+        if fraction_lost < self.LOSS_RECOVER:
+            self.good_polls += 1
+            if self.good_polls >= self.RECOVER_POLLS and self.level > 0:
+                self.good_polls = 0
+                self.level -= 1
+                return True
+        else:
+            self.good_polls = 0
+        return False
+
+    def rung_key(self, requested_key):
+        """Degrau do nível atual: fps cai nos níveis ímpares, resolução nos pares"""
+        scale_divisor, fps_divisor = requested_key
+        scales = ScreenCaptureEngine.SCALE_LADDER
+        fps_steps = ScreenCaptureEngine.FPS_LADDER
+        scale_index = min(scales.index(scale_divisor) + self.level // 2, len(scales) - 1)
+        fps_index = min(fps_steps.index(fps_divisor) + (self.level + 1) // 2, len(fps_steps) - 1)
+        return scales[scale_index], fps_steps[fps_index]
+
+
+def capture_snapshot(monitor_number, max_width=None, max_height=None, image_format='jpeg', quality=60):
+    """
+    Captura um único frame do monitor, reduz para caber em max_width x
+    max_height e codifica em JPEG ou WebP. Roda fora do event loop.
+    """
+    load_capture_stack()
+    with mss.mss() as sct:
+        if monitor_number <= 0 or monitor_number >= len(sct.monitors):
+            monitor_number = 1
+        shot = sct.grab(sct.monitors[monitor_number])
+    bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / shot.width)
+    if max_height:
+        scale = min(scale, max_height / shot.height)
+    if scale < 1.0:
+        size = (max(1, int(shot.width * scale)), max(1, int(shot.height * scale)))
+        bgra = cv2.resize(bgra, size, interpolation=cv2.INTER_AREA)
+    bgr = cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR)
+
+    if image_format == 'webp':
+        ok, encoded = cv2.imencode('.webp', bgr, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    else:
+        image_format = 'jpeg'
+        ok, encoded = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return None
+    return {
+        'monitor_number': monitor_number,
+        'format': image_format,
+        'width': bgr.shape[1],
+        'height': bgr.shape[0],
+        'image': encoded.tobytes(),
+    }
+
+
+def get_idle_seconds():
+    """Segundos desde o último input do usuário (só no Windows; 0 nos demais)"""
+    try:
+        if sistema_operacional == "Windows":
+            try:
+                import ctypes
+
+                class LASTINPUTINFO(ctypes.Structure):
+                    _fields_ = [('cbSize', ctypes.c_uint),
+                                ('dwTime', ctypes.c_uint)]
+
+                lii = LASTINPUTINFO()
+                lii.cbSize = ctypes.sizeof(LASTINPUTINFO)
+                ctypes.windll.user32.GetLastInputInfo(ctypes.byref(lii))
+                millis = ctypes.windll.kernel32.GetTickCount() - lii.dwTime
+                return millis / 1000.0
+            except:
+                pass
+        return 0
+    except Exception as e:
+        print(f"❌ Erro ao verificar ociosidade: {e}")
+        return 0
+
+
+# Menor lado aceito para uma região de captura
+MIN_CAPTURE_REGION = 64
+
+
+def parse_capture_region(region):
+    """
+    Normaliza o campo "region" do new-viewer: None (monitor inteiro),
+    'foreground' (janela em primeiro plano) ou (x, y, largura, altura)
+    relativos ao canto do monitor.
+    """
+    if not region:
+        return None
+    if region == 'foreground':
+        return 'foreground'
+    try:
+        return tuple(int(region[key]) for key in ('x', 'y', 'width', 'height'))
+    except (TypeError, KeyError, ValueError):
+        print(f"⚠️ Região de captura inválida, usando o monitor inteiro: {region}")
+        return None
+
+
+def clip_capture_rect(monitor, left, top, width, height):
+    """Retângulo (formato do mss) recortado ao monitor; None se sobrar pouco dele"""
+    x0 = max(left, monitor['left'])
+    y0 = max(top, monitor['top'])
+    x1 = min(left + width, monitor['left'] + monitor['width'])
+    y1 = min(top + height, monitor['top'] + monitor['height'])
+    if x1 - x0 < MIN_CAPTURE_REGION or y1 - y0 < MIN_CAPTURE_REGION:
+        return None
+    return {'left': x0, 'top': y0, 'width': x1 - x0, 'height': y1 - y0}
+
+
+def get_foreground_bounds():
+    """
+    (left, top, largura, altura) da janela em primeiro plano, a mesma que
+    get_active_windows reporta. Só no Windows; None nos demais sistemas ou
+    com a janela minimizada.
+    """
+    if sistema_operacional != "Windows":
+        return None
+    try:
+        import win32gui
+        hwnd = win32gui.GetForegroundWindow()
+        if not hwnd or win32gui.IsIconic(hwnd):
+            return None
+        left, top, right, bottom = win32gui.GetWindowRect(hwnd)
+        return left, top, right - left, bottom - top
+    except Exception:
+        return None
+
 
 class Broadcaster:
 
@@ -226,7 +2005,9 @@ class Broadcaster:
                  broadcaster_token=None,
                  broadcaster_id=None,
                  is_installation=False,
-                 token_expires_at=None):
+                 token_expires_at=None,
+                 video_config=None,
+                 monitoring_config=None):
         """
         Inicializa o Broadcaster.
         
@@ -238,6 +2019,8 @@ class Broadcaster:
             broadcaster_id: ID único do broadcaster (salvo após primeira instalação)
             is_installation: True se for primeira instalação com installation_token
             token_expires_at: Data de expiração do token (para verificar renovação)
+            video_config: Ajustes de captura (sobrescrevem DEFAULT_VIDEO_CONFIG)
+            monitoring_config: Ritmo da coleta (sobrescreve DEFAULT_MONITORING_CONFIG)
         """
         self.signaling_url = signaling_url
         self.broadcaster_name = broadcaster_name
@@ -246,42 +2029,64 @@ class Broadcaster:
         self.broadcaster_id = broadcaster_id
         self.is_installation = is_installation
         self.token_expires_at = token_expires_at
+        self.video_config = {**DEFAULT_VIDEO_CONFIG, **(video_config or {})}
+        self.monitoring_config = {**DEFAULT_MONITORING_CONFIG, **(monitoring_config or {})}
         self.peers = {}
+        self.video_tracks = {}
+        self.capture_engines = {}
+        self.virtual_screen = VirtualScreenGrabber()
         self.should_reconnect = True
         self.socket = None
+        self.outbound = None
+        # Fila de saída só depois do auth-success: antes disso o servidor ainda
+        # não conhece o broadcaster e descartaria o monitoramento
+        self.authenticated_outbound = None
         self.monitoring_task = None
+        self.congestion_task = None
+        self.viewer_quality = {}
+        self.congestion_poll_interval = 2
+        self.snapshot_subscribers = {}
+        self.snapshot_task = None
+        # Pedidos avulsos (snapshot-request) em andamento
+        self.snapshot_request_tasks = set()
+        # Importação da pilha de vídeo (compartilhada) e negociação de cada viewer
+        self.video_stack_task = None
+        self.viewer_tasks = {}
+        self.process_cache = ProcessInfoCache()
         self.last_input_time = time.time()
         self.last_mouse_pos = None
         self.idle_threshold = 60
-        self.history_counter = 0
-        self.history_interval = 30
-        self.browser_history_cache = []
+        self.history_task = None
+        self.history_interval = 60
+        self.history_watermarks = load_history_state()
+        self.history_batch = None
+        self.server_capabilities = set()
+        self.monitoring_encoder = MonitoringDeltaEncoder()
+        # Uma espera longa de amostragem ociosa não pode fechar o intervalo em aberto
+        self.span_aggregator = ActivitySpanAggregator(
+            gap_tolerance=self.monitoring_config['idle_max_interval'] + ActivitySpanAggregator.GAP_TOLERANCE)
+        self.sampling_scheduler = SamplingScheduler(self.monitoring_config)
+        self.last_sample_time = None
+        self.last_apps_key = None
+        self.monitoring_batcher = MonitoringBatcher()
+        self.last_monitoring_state = None
+        self.monitoring_outbound = None
+        self.unsent_samples = []
+        self.spool = None
+        self.spool_task = None
+        self.spool_replay_batch = 50
+        self.spool_replay_interval = 1.0
+        self.session_token = None
+        self.retry_after_hint = None
+        self.reconnect_attempt = 0
+        self.reconnect_max_delay = 30
         self.token_renewal_checked = False
 
     def check_idle_time(self):
         """Detecta tempo de ociosidade do usuário"""
-        try:
-            if sistema_operacional == "Windows":
-                try:
-                    import ctypes
-
-                    class LASTINPUTINFO(ctypes.Structure):
-                        _fields_ = [('cbSize', ctypes.c_uint),
-                                    ('dwTime', ctypes.c_uint)]
-
-                    lii = LASTINPUTINFO()
-                    lii.cbSize = ctypes.sizeof(LASTINPUTINFO)
-                    ctypes.windll.user32.GetLastInputInfo(ctypes.byref(lii))
-                    millis = ctypes.windll.kernel32.GetTickCount() - lii.dwTime
-                    return millis / 1000.0
-                except:
-                    pass
-            return 0
-        except Exception as e:
-            print(f"❌ Erro ao verificar ociosidade: {e}")
-            return 0
+        return get_idle_seconds()
 
-    async def check_and_renew_token(self, socket):
+    def check_and_renew_token(self):
         """Verifica se o token está próximo de expirar e solicita renovação"""
         try:
             from dateutil import parser
@@ -290,7 +2095,7 @@ class Broadcaster:
             
             if days_until_expiry <= 7:
                 print(f"⚠️ Token expira em {days_until_expiry} dias. Solicitando renovação automática...")
-                await socket.send(json.dumps({"type": "renew-token"}))
+                self.outbound.put(json.dumps({"type": "renew-token"}), OutboundQueue.SIGNALING)
             else:
                 print(f"✅ Token válido por mais {days_until_expiry} dias")
         except Exception as e:
@@ -325,6 +2130,8 @@ class Broadcaster:
         foreground_app = None
 
         try:
+            # Uma listagem de pids por tick; nomes de processos já vistos vêm do cache
+            pids = self.process_cache.refresh()
             if sistema_operacional == "Windows":
                 try:
                     import win32gui
@@ -336,15 +2143,13 @@ class Broadcaster:
                             if title:
                                 _, pid = win32process.GetWindowThreadProcessId(
                                     hwnd)
-                                try:
-                                    process = psutil.Process(pid)
+                                name = self.process_cache.name(pid)
+                                if name:
                                     windows.append({
                                         "title": title,
-                                        "app": process.name(),
+                                        "app": name,
                                         "pid": pid
                                     })
-                                except:
-                                    pass
 
                     windows = []
                     win32gui.EnumWindows(callback, windows)
@@ -355,48 +2160,53 @@ class Broadcaster:
                         fg_title = win32gui.GetWindowText(fg_hwnd)
                         _, fg_pid = win32process.GetWindowThreadProcessId(
                             fg_hwnd)
-                        try:
-                            fg_process = psutil.Process(fg_pid)
+                        fg_name = self.process_cache.name(fg_pid)
+                        if fg_name:
                             foreground_app = {
                                 "title": fg_title,
-                                "app": fg_process.name(),
+                                "app": fg_name,
                                 "pid": fg_pid
                             }
-                        except:
-                            pass
                 except ImportError:
                     print("⚠️ win32gui não disponível, usando apenas psutil")
-                    for proc in psutil.process_iter(['name', 'pid']):
-                        try:
-                            apps.append({
-                                "title": proc.info['name'],
-                                "app": proc.info['name'],
-                                "pid": proc.info['pid']
-                            })
-                            if len(apps) >= 20:
-                                break
-                        except:
-                            pass
+                    apps = self._list_processes(pids)
             else:
-                for proc in psutil.process_iter(['name', 'pid']):
-                    try:
-                        apps.append({
-                            "title": proc.info['name'],
-                            "app": proc.info['name'],
-                            "pid": proc.info['pid']
-                        })
-                        if len(apps) >= 20:
-                            break
-                    except:
-                        pass
+                apps = self._list_processes(pids)
         except Exception as e:
             print(f"❌ Erro ao coletar apps: {e}")
 
         return apps, foreground_app
 
-    async def send_monitoring_data(self, socket):
+    def _list_processes(self, pids, limit=20):
+        """Sem enumeração de janelas: os primeiros processos em ordem de pid"""
+        apps = []
+        for pid in pids:
+            name = self.process_cache.name(pid)
+            if name:
+                apps.append({
+                    "title": name,
+                    "app": name,
+                    "pid": pid
+                })
+                if len(apps) >= limit:
+                    break
+        return apps
+
+    async def send_monitoring_data(self):
+        """
+        Coleta amostras enquanto o processo roda, no ritmo do
+        SamplingScheduler (mais rápido após mudanças, espaçado em períodos
+        ociosos ou parados). Cada amostra leva em "interval" o tempo medido
+        desde a anterior, que o servidor grava como a duração da anterior.
+        Autenticado, envia conforme os recursos
+        negociados (delta, lote, compressão); sem conexão ou antes do
+        auth-success, guarda a amostra no spool em disco para ser reenviada
+        depois do próximo auth-success.
+        """
         print("🔄 Iniciando envio de dados de monitoramento...")
         while self.should_reconnect:
+            next_interval = self.monitoring_config['interval']
+            idle_seconds = 0
             try:
                 apps, foreground = self.get_active_windows()
 
@@ -407,16 +2217,14 @@ class Broadcaster:
                     active_url = self.extract_url_from_title(
                         foreground.get('title', ''), foreground.get('app', ''))
 
-                self.history_counter += 1
-                if self.history_counter >= self.history_interval:
-                    print("🔍 Lendo histórico de navegação...")
-                    self.browser_history_cache = get_browser_history(hours_back=24)
-                    self.history_counter = 0
-                    print(f"📚 {len(self.browser_history_cache)} entradas de histórico coletadas")
+                # Lote entregue pela coleta em segundo plano, se houver
+                history_batch = self.history_batch
+                history_entries = history_batch[0] if history_batch else []
 
                 monitoring_data = {
                     "type": "monitoring",
-                    "timestamp": datetime.now().isoformat(),
+                    # UTC com fuso explícito: o servidor grava no mesmo referencial do CURRENT_TIMESTAMP
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
                     "host": nome_computador,
                     "apps": apps,
                     "foreground": foreground,
@@ -424,23 +2232,254 @@ class Broadcaster:
                     "idle_seconds": round(idle_seconds, 1),
                     "active_url": active_url,
                     "is_idle": idle_seconds > self.idle_threshold,
-                    "browser_history": self.browser_history_cache if self.history_counter == 0 else []
+                    "interval": self._sample_interval(),
+                    "browser_history": history_entries
                 }
 
                 print(
-                    f"📤 Enviando dados: {len(apps)} apps, idle: {idle_seconds:.1f}s, URL: {active_url or 'N/A'}, História: {len(self.browser_history_cache)} URLs"
+                    f"📤 Enviando dados: {len(apps)} apps, idle: {idle_seconds:.1f}s, URL: {active_url or 'N/A'}, História: {len(history_entries)} URLs"
                 )
-                await socket.send(json.dumps(monitoring_data))
+                # Troca de janela e transição de ociosidade aparecem ao vivo para os
+                # viewers; histórico e intervalos fechados saem na hora para não
+                # ficarem presos num lote se a conexão cair
+                monitoring_state = ((foreground or {}).get('app'), (foreground or {}).get('title'),
+                                    monitoring_data["is_idle"])
+                urgent = monitoring_state != self.last_monitoring_state or bool(history_entries)
+                apps_key = frozenset(MonitoringDeltaEncoder.app_key(app) for app in apps)
+                changed = monitoring_state != self.last_monitoring_state or apps_key != self.last_apps_key
+                self.last_monitoring_state = monitoring_state
+                self.last_apps_key = apps_key
+
+                next_interval = self.sampling_scheduler.next_interval(changed, monitoring_data["is_idle"])
+                # Com a próxima amostra distante, o lote não espera por ela
+                urgent = urgent or next_interval >= self.monitoring_batcher.max_latency
+
+                # Agrega sempre, mesmo antes do primeiro auth-success: um host que
+                # iniciou sem conexão guarda no spool amostras já com os intervalos
+                monitoring_data["activity_spans"] = self.span_aggregator.add(monitoring_data)
+                if 'activity-spans' in self.server_capabilities:
+                    urgent = urgent or bool(monitoring_data["activity_spans"])
+
+                outbound = self.authenticated_outbound
+                if outbound is not self.monitoring_outbound:
+                    # Conexão nova ou perdida: o que estava no lote não chegou a sair.
+                    # Retomando a sessão, o servidor guarda o estado base e a
+                    # sequência, e os deltas continuam de onde pararam
+                    self._spool_unsent_samples()
+                    if not self.session_token:
+                        self.monitoring_encoder.reset()
+                    self.monitoring_batcher.reset()
+                    self.monitoring_outbound = outbound
+
+                if outbound is None:
+                    self._spool_samples([monitoring_data])
+                else:
+                    self._send_monitoring_sample(outbound, monitoring_data, urgent)
 
-                await asyncio.sleep(2)
+                # Só avança a marca d'água com as visitas na fila de saída ou no spool
+                # (o que a fila descartar vai para o spool)
+                if history_batch:
+                    self._commit_history_batch(history_batch)
             except Exception as e:
                 print(f"❌ Erro ao enviar monitoramento: {e}")
                 import traceback
                 traceback.print_exc()
-                break
+
+            await self._wait_next_sample(next_interval, idle_seconds)
+
+    def _sample_interval(self):
+        """
+        Segundos reais desde a amostra anterior (None na primeira). É a
+        duração da amostra anterior: a espera pode acabar antes do planejado
+        (usuário voltou), então o tempo planejado sobreporia as amostras.
+        """
+        now = time.monotonic()
+        interval = round(now - self.last_sample_time, 1) if self.last_sample_time is not None else None
+        self.last_sample_time = now
+        return interval
+
+    async def _wait_next_sample(self, interval, idle_seconds):
+        """
+        Espera até a próxima amostra. Em esperas longas consulta só o tempo
+        ocioso (barato) a cada idle_poll_interval e acorda assim que o
+        usuário volta, para a transição não esperar a amostragem espaçada.
+        """
+        deadline = time.monotonic() + interval
+        poll_interval = self.monitoring_config['idle_poll_interval']
+        while self.should_reconnect:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, poll_interval))
+            if idle_seconds > self.idle_threshold and self.check_idle_time() < idle_seconds:
+                return
+
+    def _send_monitoring_sample(self, outbound, sample, urgent):
+        compress = 'monitoring-deflate' in self.server_capabilities
+        if 'activity-spans' not in self.server_capabilities:
+            # Servidor sem intervalos agregados grava cada amostra
+            sample = {key: value for key, value in sample.items() if key != 'activity_spans'}
+        if 'browser-history' in self.server_capabilities and sample['browser_history']:
+            # Histórico sai em mensagens próprias, de prioridade mais baixa que
+            # as amostras, sem quebrar a sequência dos deltas
+            entries = sample['browser_history']
+            sample = {**sample, 'browser_history': []}
+            for start in range(0, len(entries), HISTORY_CHUNK_SIZE):
+                chunk = entries[start:start + HISTORY_CHUNK_SIZE]
+                outbound.put(
+                    pack_monitoring_payload(encode_monitoring({"type": "browser-history", "entries": chunk}), compress),
+                    OutboundQueue.HISTORY, droppable=True,
+                    on_drop=lambda chunk=chunk: self._spool_history(chunk))
+
+        message = sample
+        if 'monitoring-delta' in self.server_capabilities:
+            message = self.monitoring_encoder.encode(sample)
+        payload = encode_monitoring(message)
+        self.unsent_samples.append(sample)
+        if 'monitoring-batch' in self.server_capabilities:
+            payload = self.monitoring_batcher.add(payload, urgent=urgent)
+            if payload is None:
+                return
+        samples, self.unsent_samples = self.unsent_samples, []
+        outbound.put(pack_monitoring_payload(payload, compress), OutboundQueue.MONITORING, droppable=True,
+                     on_drop=lambda: self._monitoring_dropped(outbound, samples))
+
+    def _monitoring_dropped(self, outbound, samples):
+        """Amostras que não saíram (congestionamento ou queda) vão para o spool"""
+        self._spool_samples(samples)
+        if self.authenticated_outbound is outbound:
+            # Ainda conectado: o servidor perdeu um delta, o próximo sai completo,
+            # e o spool é reenviado quando a conexão tiver folga
+            self.monitoring_encoder.request_keyframe()
+            if not self.spool_task or self.spool_task.done():
+                self.spool_task = asyncio.create_task(self.replay_spool(outbound))
+
+    def _monitoring_spool(self, create=True):
+        if self.spool is None and (create or SPOOL_FILE.exists()):
+            self.spool = MonitoringSpool()
+        return self.spool
+
+    def _spool_samples(self, samples):
+        # Com intervalos agregados o servidor só grava intervalos e histórico;
+        # as amostras em si só interessam a quem está assistindo ao vivo
+        if 'activity-spans' in self.server_capabilities:
+            samples = [sample for sample in samples
+                       if sample.get('activity_spans') or sample.get('browser_history')]
+        if not samples:
+            return
+        try:
+            spool = self._monitoring_spool()
+            for sample in samples:
+                spool.append(encode_monitoring({**sample, 'replayed': True}))
+        except Exception as e:
+            print(f"❌ Erro ao gravar spool de monitoramento: {e}")
+
+    def _flush_activity_span(self):
+        """Fecha o intervalo em aberto ao encerrar e o guarda no spool para a próxima execução"""
+        spans = self.span_aggregator.flush()
+        if not spans:
+            return
+        span = spans[0]
+        self._spool_samples([{
+            "type": "monitoring",
+            "timestamp": span['end'],
+            "host": nome_computador,
+            "apps": span['apps'],
+            "foreground": span['foreground'],
+            "system": sistema_operacional,
+            "idle_seconds": span['idle_seconds'],
+            "active_url": span['active_url'],
+            "is_idle": span['is_idle'],
+            "interval": None,
+            "browser_history": [],
+            "activity_spans": spans
+        }])
+
+    def _spool_history(self, entries):
+        try:
+            self._monitoring_spool().append(
+                encode_monitoring({"type": "browser-history", "entries": entries, "replayed": True}))
+        except Exception as e:
+            print(f"❌ Erro ao gravar spool de monitoramento: {e}")
+
+    def _spool_unsent_samples(self):
+        samples, self.unsent_samples = self.unsent_samples, []
+        self._spool_samples(samples)
+
+    async def replay_spool(self, outbound):
+        """
+        Reenvia o spool em lotes, com a prioridade mais baixa da fila de saída
+        e intervalo entre eles para não sobrecarregar o servidor. Cada lote só
+        sai do spool depois de enviado.
+        """
+        spool = self._monitoring_spool(create=False)
+        if not spool or not spool.count:
+            return
+        print(f"📼 Reenviando {spool.count} amostra(s) guardadas sem conexão...")
+        sent = 0
+        while self.authenticated_outbound is outbound and spool.count:
+            rows = spool.peek(self.spool_replay_batch)
+            payloads = [payload for _, payload in rows]
+            if 'monitoring-batch' in self.server_capabilities:
+                payloads = ['{"type":"monitoring-batch","messages":[' + ','.join(payloads) + ']}']
+            for payload in payloads:
+                if not await outbound.send(pack_monitoring_payload(
+                        payload, 'monitoring-deflate' in self.server_capabilities), OutboundQueue.HISTORY):
+                    return
+            spool.remove_through(rows[-1][0])
+            sent += len(rows)
+            await asyncio.sleep(self.spool_replay_interval)
+        print(f"📼 {sent} amostra(s) do spool reenviadas")
+
+    async def collect_browser_history(self):
+        """
+        Lê o histórico numa thread do executor, no seu próprio ritmo, e deixa
+        o lote em self.history_batch para o próximo envio de monitoramento.
+        Um navegador lento nunca atrasa o heartbeat, o ICE ou o vídeo.
+        """
+        loop = asyncio.get_running_loop()
+        while self.should_reconnect:
+            # Enquanto o lote anterior não for entregue, as marcas d'água não
+            # avançaram; ler de novo só duplicaria as mesmas visitas
+            if self.history_batch is None:
+                try:
+                    print("🔍 Lendo histórico de navegação...")
+                    started = time.perf_counter()
+                    entries, watermarks = await loop.run_in_executor(
+                        None, get_browser_history, 24, self.history_watermarks)
+                    print(f"📚 {len(entries)} entradas novas de histórico coletadas "
+                          f"em {time.perf_counter() - started:.1f}s")
+                    if entries:
+                        self.history_batch = (entries, watermarks)
+                    elif watermarks != self.history_watermarks:
+                        # Nada a enviar, mas as impressões digitais dos bancos mudaram
+                        self._commit_history_batch((entries, watermarks))
+                except Exception as e:
+                    print(f"❌ Erro na coleta de histórico: {e}")
+            await asyncio.sleep(self.history_interval)
+
+    def _commit_history_batch(self, history_batch):
+        _, watermarks = history_batch
+        self.history_watermarks = watermarks
+        if self.history_batch is history_batch:
+            self.history_batch = None
+        save_history_state(watermarks)
+
+    def reconnect_delay(self):
+        """
+        Backoff exponencial com jitter (metade fixa, metade aleatória), para
+        que broadcasters derrubados juntos não voltem todos no mesmo instante.
+        Um retry-after do servidor é respeitado como piso.
+        """
+        ceiling = min(2 ** self.reconnect_attempt, self.reconnect_max_delay)
+        self.reconnect_attempt += 1
+        delay = random.uniform(ceiling / 2, ceiling)
+        if self.retry_after_hint:
+            delay = max(delay, self.retry_after_hint + random.uniform(0, 1))
+            self.retry_after_hint = None
+        return delay
 
     async def connect(self):
-        retry_delay = 1
         while self.should_reconnect:
             try:
                 print(
@@ -448,14 +2487,20 @@ class Broadcaster:
                 )
                 async with websockets.connect(self.signaling_url) as socket:
                     self.socket = socket
+                    # Todas as escritas no socket passam pela fila de saída
+                    self.outbound = OutboundQueue(socket)
                     print("✅ Conectado ao servidor de sinalização.")
-                    retry_delay = 1
+                    # Inscrições de snapshot não sobrevivem à reconexão
+                    self._clear_snapshot_subscriptions()
+                    if not self.session_token:
+                        self.server_capabilities = set()
 
                     registration_data = {
                         "type": "broadcaster",
                         "monitor_number": 1,
                         "broadcaster_name": self.broadcaster_name,
-                        "company_id": self.company_id
+                        "company_id": self.company_id,
+                        "capabilities": MONITORING_CAPABILITIES
                     }
                     
                     if self.broadcaster_token:
@@ -467,21 +2512,40 @@ class Broadcaster:
                             print(f"🔐 Primeira instalação - usando installation_token...")
                     else:
                         print(f"⚠️ AVISO: Modo legado (sem token). Recomenda-se obter um token JWT para segurança.")
+
+                    if self.session_token:
+                        registration_data["session_token"] = self.session_token
+                        registration_data["monitoring_seq"] = self.monitoring_encoder.seq
+                        print(f"⚡ Tentando retomar a sessão anterior...")
                     
-                    await socket.send(json.dumps(registration_data))
+                    self.outbound.put(json.dumps(registration_data), OutboundQueue.SIGNALING)
                     print(f"📡 Registrado como: {self.broadcaster_name}")
 
-                    self.monitoring_task = asyncio.create_task(
-                        self.send_monitoring_data(socket))
+                    if not self.monitoring_task or self.monitoring_task.done():
+                        self.monitoring_task = asyncio.create_task(self.send_monitoring_data())
+                    if not self.history_task or self.history_task.done():
+                        self.history_task = asyncio.create_task(self.collect_browser_history())
 
                     if not self.token_renewal_checked and self.broadcaster_id and self.token_expires_at:
-                        await self.check_and_renew_token(socket)
+                        self.check_and_renew_token()
                         self.token_renewal_checked = True
                     
                     async for msg in socket:
                         data = json.loads(msg)
                         
                         if data["type"] == "auth-success":
+                            self._handle_session(data)
+                            self.server_capabilities = set(data.get("capabilities") or [])
+                            if self.server_capabilities:
+                                print(f"🧩 Recursos negociados com o servidor: {', '.join(sorted(self.server_capabilities))}")
+                            self.outbound.candidate_batch = 'candidate-batch' in self.server_capabilities
+                            # Daí em diante o monitoramento sai pela conexão em vez do spool
+                            self.authenticated_outbound = self.outbound
+                            # Só uma conexão aceita zera o backoff: um servidor que abre o
+                            # socket e derruba antes do auth não vira laço de reconexão imediata
+                            self.reconnect_attempt = 0
+                            if not self.spool_task or self.spool_task.done():
+                                self.spool_task = asyncio.create_task(self.replay_spool(self.outbound))
                             if not self.broadcaster_id and data.get("broadcaster_id"):
                                 self.broadcaster_id = data["broadcaster_id"]
                                 permanent_token = data.get("token")
@@ -515,50 +2579,147 @@ class Broadcaster:
                                 self.token_expires_at = token_expires_at
                                 print(f"🔄 Token renovado com sucesso! Válido até: {token_expires_at}")
                         
+                        elif data["type"] == "retry-after":
+                            self.retry_after_hint = float(data.get("retry_after") or 0)
+                            print(f"⏳ Servidor ocupado, nova tentativa em ~{self.retry_after_hint:.0f}s")
+                        elif data["type"] == "monitoring-keyframe-request":
+                            self.monitoring_encoder.request_keyframe()
                         elif data["type"] == "new-viewer":
-                            await self._handle_new_viewer(socket, data)
+                            # A importação da pilha de vídeo não segura o laço de sinalização
+                            self._dispatch_new_viewer(data)
                         elif data["type"] == "answer":
                             await self._handle_answer(data)
                         elif data["type"] == "candidate":
                             await self._handle_candidate(data)
                         elif data["type"] == "viewer-disconnected":
+                            self.snapshot_subscribers.pop(data["viewerId"], None)
                             await self._handle_viewer_disconnected(data)
+                        elif data["type"] == "snapshot-subscribe":
+                            self._handle_snapshot_subscribe(data)
+                        elif data["type"] == "snapshot-unsubscribe":
+                            self._handle_snapshot_unsubscribe(data)
+                        elif data["type"] == "snapshot-request":
+                            # Captura e codificação fora do laço: answers e candidates não esperam
+                            self._dispatch_snapshot_request(data)
 
+                # Fechamento normal (ex.: servidor reiniciando) também espera
+                self._connection_lost()
+                if self.should_reconnect:
+                    delay = self.reconnect_delay()
+                    print(f"⚠️ Conexão encerrada pelo servidor: tentando reconectar em {delay:.1f}s...")
+                    await asyncio.sleep(delay)
             except (websockets.exceptions.ConnectionClosedError,
                     ConnectionRefusedError) as e:
+                self._connection_lost()
+                delay = self.reconnect_delay()
                 print(
-                    f"⚠️ Conexão perdida ({type(e).__name__}): tentando reconectar em {retry_delay}s..."
+                    f"⚠️ Conexão perdida ({type(e).__name__}): tentando reconectar em {delay:.1f}s..."
                 )
-                await asyncio.sleep(retry_delay)
-                retry_delay = min(retry_delay * 2, 30)
+                await asyncio.sleep(delay)
             except Exception as e:
+                self._connection_lost()
                 print(f"❌ Erro inesperado: {e}")
-                await asyncio.sleep(5)
+                await asyncio.sleep(self.reconnect_delay())
         print("🛑 Reconexão desativada, encerrando.")
 
-    async def _handle_new_viewer(self, socket, data):
+    def _connection_lost(self):
+        """Descarta a fila de saída da conexão encerrada (o monitoramento pendente vai para o spool)"""
+        outbound, self.outbound, self.socket = self.outbound, None, None
+        self.authenticated_outbound = None
+        if outbound:
+            outbound.close()
+
+    def _handle_session(self, data):
+        """Guarda o token de retomada e alinha o delta com a sequência que o servidor conhece"""
+        resumed = bool(data.get("resumed"))
+        if self.session_token and not resumed:
+            # Sessão não aceita (expirou ou servidor reiniciou): começa do zero
+            self.monitoring_encoder.reset()
+        elif resumed:
+            server_seq = data.get("monitoring_seq")
+            if server_seq != self.monitoring_encoder.seq:
+                self.monitoring_encoder.request_keyframe()
+            print(f"⚡ Sessão retomada (seq servidor {server_seq}, local {self.monitoring_encoder.seq})")
+        self.session_token = data.get("session_token")
+
+    async def _load_video_stack(self):
+        """Carrega a pilha de vídeo numa thread, sem travar a sinalização durante a importação"""
+        if VideoStreamTrack is not None:
+            return
+        started = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, load_video_stack)
+        apply_encoder_settings(self.video_config)
+        print(f"🎬 Pilha de vídeo carregada em {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def _release_video_resources(self):
+        """
+        Sem viewers, solta o que sobrou da captura (último grab da tela
+        virtual, frames e buffers já sem referência). Os módulos continuam
+        importados: extensões nativas não podem ser descarregadas.
+        """
+        self.virtual_screen = VirtualScreenGrabber()
+        gc.collect()
+
+    def _video_stack_ready(self):
+        """Tarefa única de importação da pilha de vídeo; refeita se a anterior falhou"""
+        if self.video_stack_task is None or (self.video_stack_task.done() and VideoStreamTrack is None):
+            self.video_stack_task = asyncio.create_task(self._load_video_stack())
+        return self.video_stack_task
+
+    def _dispatch_new_viewer(self, data):
+        viewer_id = data["viewerId"]
+        previous = self.viewer_tasks.pop(viewer_id, None)
+        if previous:
+            previous.cancel()
+        task = asyncio.create_task(self._run_new_viewer(data))
+        self.viewer_tasks[viewer_id] = task
+        task.add_done_callback(
+            lambda done: self.viewer_tasks.pop(viewer_id, None) if self.viewer_tasks.get(viewer_id) is done else None)
+
+    async def _run_new_viewer(self, data):
+        try:
+            await self._handle_new_viewer(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Erro ao iniciar transmissão para {data.get('viewerId')}: {e}")
+            await self._handle_viewer_disconnected({"viewerId": data.get("viewerId")})
+
+    async def _handle_new_viewer(self, data):
+        # shield: um viewer que sai durante a importação não a cancela para os demais
+        await asyncio.shield(self._video_stack_ready())
         viewer_id = data["viewerId"]
         monitor_number = int(data.get("monitor_number", 1))
-        print(f"👀 Novo viewer {viewer_id} solicitou monitor {monitor_number}")
+        max_width = data.get("max_width")
+        max_height = data.get("max_height")
+        max_fps = data.get("max_fps")
+        region = parse_capture_region(data.get("region"))
+        print(f"👀 Novo viewer {viewer_id} solicitou monitor {monitor_number}"
+              f"{f' (região {region})' if region else ''}"
+              f" (máx: {max_width or 'nativo'}x{max_height or 'nativo'} @ {max_fps or 'máx'} fps)")
 
-        # Cria uma nova conexão para cada viewer
-        video_track = ScreenCaptureTrack(monitor_number=monitor_number)
+        # Cada viewer tem sua própria conexão, mas compartilha captura e redução
+        # com os viewers do mesmo monitor, região e degrau de resolução/fps
+        video_track = ScreenCaptureTrack(
+            self._get_capture_engine(monitor_number, region),
+            max_width=int(max_width) if max_width else None,
+            max_height=int(max_height) if max_height else None,
+            max_fps=float(max_fps) if max_fps else None,
+            keyframe_interval=self.video_config['keyframe_interval'])
         pc = RTCPeerConnection()
-        pc.addTrack(video_track)
+        video_track.sender = pc.addTrack(video_track)
+        if self.video_config['codec_preferences']:
+            transceiver = next(t for t in pc.getTransceivers() if t.sender is video_track.sender)
+            transceiver.setCodecPreferences(order_codec_preferences(self.video_config['codec_preferences']))
 
         @pc.on("icecandidate")
         async def on_icecandidate(event):
-            if event.candidate:
-                await socket.send(
-                    json.dumps({
-                        "type": "candidate",
-                        "candidate": {
-                            "candidate": event.candidate.candidate,
-                            "sdpMid": event.candidate.sdpMid,
-                            "sdpMLineIndex": event.candidate.sdpMLineIndex
-                        },
-                        "targetId": viewer_id
-                    }))
+            if event.candidate and self.outbound:
+                self.outbound.put_candidate(viewer_id, {
+                    "candidate": event.candidate.candidate,
+                    "sdpMid": event.candidate.sdpMid,
+                    "sdpMLineIndex": event.candidate.sdpMLineIndex
+                })
 
         @pc.on("connectionstatechange")
         async def on_connectionstatechange():
@@ -566,24 +2727,255 @@ class Broadcaster:
             if pc.connectionState in ["failed", "disconnected", "closed"]:
                 await self._handle_viewer_disconnected({"viewerId": viewer_id})
 
+        # Registrado antes do offer: um viewer-disconnected durante a negociação libera tudo
+        self.peers[viewer_id] = pc
+        self.video_tracks[viewer_id] = video_track
+        self.viewer_quality[viewer_id] = ViewerQuality()
+
         offer = await pc.createOffer()
         await pc.setLocalDescription(offer)
+        if self.congestion_task is None:
+            self.congestion_task = asyncio.create_task(self._congestion_loop())
 
-        self.peers[viewer_id] = pc
-
-        await socket.send(
-            json.dumps({
-                "type": "offer",
-                "sdp": {
-                    "type": pc.localDescription.type,
-                    "sdp": pc.localDescription.sdp
-                },
-                "targetId": viewer_id
-            }))
+        if self.outbound:
+            self.outbound.put(
+                json.dumps({
+                    "type": "offer",
+                    "sdp": {
+                        "type": pc.localDescription.type,
+                        "sdp": pc.localDescription.sdp
+                    },
+                    "targetId": viewer_id
+                }), OutboundQueue.SIGNALING)
         print(
             f"📤 Offer enviado para {viewer_id} — {len(self.peers)} viewer(s) conectados."
         )
 
+    def _get_capture_engine(self, monitor_number, region=None):
+        """Retorna o engine de captura do monitor e região, criando-o se necessário"""
+        engine = self.capture_engines.get((monitor_number, region))
+        if engine:
+            return engine
+
+        engine = ScreenCaptureEngine(
+            monitor_number=monitor_number,
+            fps=self.video_config['fps'],
+            capture_mode=self.video_config['capture_mode'],
+            idle_fps=self.video_config['idle_fps'],
+            user_idle_fps=self.video_config['user_idle_fps'],
+            static_timeout=self.video_config['static_timeout'],
+            idle_probe=self.check_idle_time,
+            idle_threshold=self.idle_threshold,
+            region=region)
+        # Monitores inválidos caem no monitor 1, que pode já estar sendo capturado
+        existing = self.capture_engines.get((engine.monitor_number, region))
+        if existing:
+            engine.close()
+            return existing
+
+        self.capture_engines[(engine.monitor_number, region)] = engine
+        self._update_capture_layout()
+        return engine
+
+    def _update_capture_layout(self):
+        """
+        Escolhe entre um grab por monitor e um grab único da tela virtual.
+        A captura combinada só compensa com 2+ monitores assistidos cobrindo
+        boa parte da tela virtual (o grab inclui também os não assistidos).
+        A cobertura é ponderada pela taxa de grab atual de cada engine: o
+        grab combinado acontece na taxa do mais rápido, então um monitor
+        parado em idle_fps pesa pouco. Reavaliado periodicamente pelo
+        _congestion_loop, já que as taxas mudam com a atividade da tela.
+        Engines de região sempre capturam só o próprio recorte.
+        """
+        layout = self.video_config['capture_layout']
+        engines = [e for e in self.capture_engines.values() if e.region is None]
+        combined = False
+        if layout == 'combined':
+            combined = True
+        elif layout == 'auto' and len(engines) >= 2:
+            virtual = engines[0].sct.monitors[0]
+            max_fps = max(e.current_fps for e in engines)
+            watched = sum(e.monitor['width'] * e.monitor['height'] * e.current_fps for e in engines)
+            coverage = watched / (virtual['width'] * virtual['height'] * max_fps)
+            combined = coverage >= self.video_config['combined_min_coverage']
+
+        grabber = self.virtual_screen if combined else None
+        changed = False
+        for engine in engines:
+            if engine.shared_grabber is not grabber:
+                engine.shared_grabber = grabber
+                changed = True
+        if changed:
+            monitors = sorted(e.monitor_number for e in engines)
+            if combined:
+                print(f"🧩 Captura combinada da tela virtual para os monitores {monitors}")
+            else:
+                print(f"🧩 Captura individual por monitor: {monitors}")
+
+    async def _congestion_loop(self):
+        """
+        Lê getStats() de cada viewer periodicamente e ajusta resolução/fps só
+        daquele viewer conforme perda de pacotes e RTT. O bitrate já segue o
+        REMB do navegador dentro do encoder do aiortc. Também reavalia a
+        captura combinada, que depende da taxa atual de cada monitor.
+        """
+        try:
+            while self.peers:
+                await asyncio.sleep(self.congestion_poll_interval)
+                for viewer_id, pc in list(self.peers.items()):
+                    try:
+                        await self._adapt_viewer_quality(viewer_id, pc)
+                    except Exception as e:
+                        print(f"⚠️ Erro ao ler estatísticas de {viewer_id}: {e}")
+                self._update_capture_layout()
+        finally:
+            self.congestion_task = None
+
+    async def _adapt_viewer_quality(self, viewer_id, pc):
+        quality = self.viewer_quality.get(viewer_id)
+        track = self.video_tracks.get(viewer_id)
+        if not quality or not track:
+            return
+
+        report = await pc.getStats()
+        for stats in report.values():
+            if stats.type != "remote-inbound-rtp" or stats.kind != "video":
+                continue
+            # fraction_lost do RTCP vem em 1/256
+            fraction_lost = (stats.fractionLost or 0) / 256
+            if quality.update(fraction_lost, stats.roundTripTime):
+                rung_key = quality.rung_key(track.requested_rung)
+                track.switch_rung(rung_key)
+                width, height = track.rung.size_for(track.engine.capture_rect['width'],
+                                                    track.engine.capture_rect['height'])
+                print(f"📉 Viewer {viewer_id}: nível {quality.level} → {width}x{height} @ "
+                      f"{track.engine.fps / rung_key[1]:g} fps (perda {fraction_lost:.1%}, "
+                      f"RTT {stats.roundTripTime or 0:.3f}s)")
+            break
+
+    def _release_video_track(self, viewer_id):
+        """Desinscreve o track do viewer e libera engines sem viewers"""
+        track = self.video_tracks.pop(viewer_id, None)
+        self.viewer_quality.pop(viewer_id, None)
+        if track:
+            track.stop()
+        released = False
+        for key, engine in list(self.capture_engines.items()):
+            if not engine.subscribers:
+                engine.close()
+                del self.capture_engines[key]
+                released = True
+        if released:
+            self._update_capture_layout()
+
+    def _snapshot_request(self, data):
+        """Normaliza um pedido de snapshot vindo do servidor"""
+        max_width = data.get("max_width") or self.video_config['snapshot_max_width']
+        max_height = data.get("max_height")
+        return {
+            'viewer_id': data["viewerId"],
+            'monitor_number': int(data.get("monitor_number", 1)),
+            'max_width': int(max_width) if max_width else None,
+            'max_height': int(max_height) if max_height else None,
+            'last_crc': None,
+        }
+
+    def _handle_snapshot_subscribe(self, data):
+        """Modo miniatura: snapshots periódicos em vez de uma conexão WebRTC"""
+        request = self._snapshot_request(data)
+        interval = float(data.get("interval") or self.video_config['snapshot_interval'])
+        request['interval'] = max(interval, self.video_config['snapshot_min_interval'])
+        request['next_due'] = time.monotonic()
+        self.snapshot_subscribers[request['viewer_id']] = request
+        print(f"🖼️ Viewer {request['viewer_id']} inscrito em snapshots do monitor "
+              f"{request['monitor_number']} a cada {request['interval']:g}s "
+              f"({len(self.snapshot_subscribers)} inscrito(s))")
+        if self.snapshot_task is None:
+            self.snapshot_task = asyncio.create_task(self._snapshot_loop())
+
+    def _handle_snapshot_unsubscribe(self, data):
+        if self.snapshot_subscribers.pop(data["viewerId"], None):
+            print(f"🖼️ Viewer {data['viewerId']} cancelou snapshots "
+                  f"({len(self.snapshot_subscribers)} inscrito(s))")
+
+    def _dispatch_snapshot_request(self, data):
+        task = asyncio.create_task(self._send_snapshots([self._snapshot_request(data)]))
+        self.snapshot_request_tasks.add(task)
+        task.add_done_callback(self.snapshot_request_tasks.discard)
+
+    def _clear_snapshot_subscriptions(self):
+        self.snapshot_subscribers.clear()
+        if self.snapshot_task:
+            self.snapshot_task.cancel()
+            self.snapshot_task = None
+        for task in list(self.snapshot_request_tasks):
+            task.cancel()
+
+    async def _snapshot_loop(self):
+        """Envia snapshots aos inscritos; só roda enquanto houver alguém inscrito"""
+        try:
+            while self.snapshot_subscribers:
+                now = time.monotonic()
+                due = [r for r in self.snapshot_subscribers.values() if r['next_due'] <= now]
+                for request in due:
+                    request['next_due'] = now + request['interval']
+                if due:
+                    await self._send_snapshots(due)
+                if not self.snapshot_subscribers:
+                    break
+                next_due = min(r['next_due'] for r in self.snapshot_subscribers.values())
+                await asyncio.sleep(max(0.0, next_due - time.monotonic()))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.snapshot_task = None
+
+    async def _send_snapshots(self, requests):
+        """
+        Captura uma vez por combinação monitor/tamanho e envia para cada viewer.
+        Snapshots idênticos ao último enviado para o viewer são omitidos; um
+        snapshot ainda na fila é substituído pelo mais novo.
+        """
+        if self.outbound is None:
+            return
+        loop = asyncio.get_running_loop()
+        groups = {}
+        for request in requests:
+            key = (request['monitor_number'], request['max_width'], request['max_height'])
+            groups.setdefault(key, []).append(request)
+
+        for (monitor_number, max_width, max_height), group in groups.items():
+            try:
+                snapshot = await loop.run_in_executor(
+                    None, capture_snapshot, monitor_number, max_width, max_height,
+                    self.video_config['snapshot_format'], self.video_config['snapshot_quality'])
+            except Exception as e:
+                print(f"⚠️ Erro ao capturar snapshot do monitor {monitor_number}: {e}")
+                continue
+            if snapshot is None:
+                continue
+
+            crc = zlib.crc32(snapshot['image'])
+            image = base64.b64encode(snapshot['image']).decode('ascii')
+            for request in group:
+                if request['last_crc'] == crc:
+                    continue
+                request['last_crc'] = crc
+                if self.outbound is None:
+                    return
+                self.outbound.put(json.dumps({
+                    "type": "snapshot",
+                    "targetId": request['viewer_id'],
+                    "monitor_number": snapshot['monitor_number'],
+                    "format": snapshot['format'],
+                    "width": snapshot['width'],
+                    "height": snapshot['height'],
+                    "image": image,
+                    "timestamp": datetime.now(timezone.utc).isoformat()
+                }), OutboundQueue.MONITORING, key=('snapshot', request['viewer_id'], snapshot['monitor_number']),
+                    droppable=True, on_drop=lambda request=request: request.update(last_crc=None))
+
     async def _handle_answer(self, data):
         viewer_id = data["senderId"]
         pc = self.peers.get(viewer_id)
@@ -615,25 +3007,53 @@ class Broadcaster:
 
     async def _handle_viewer_disconnected(self, data):
         viewer_id = data["viewerId"]
+        task = self.viewer_tasks.pop(viewer_id, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
         pc = self.peers.pop(viewer_id, None)
+        self._release_video_track(viewer_id)
         if pc:
             await pc.close()
             print(f"👋 Viewer {viewer_id} desconectado.")
         if not self.peers:
+            self._release_video_resources()
             print("🛑 Nenhum viewer ativo — transmissão encerrada.")
 
     async def stop(self):
         self.should_reconnect = False
         if self.monitoring_task:
             self.monitoring_task.cancel()
-        for pc in self.peers.values():
+        if self.history_task:
+            self.history_task.cancel()
+        if self.spool_task:
+            self.spool_task.cancel()
+        # Antes de fechar o spool: o que estava na fila de saída vai para ele
+        self._connection_lost()
+        self._flush_activity_span()
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+        if self.congestion_task:
+            self.congestion_task.cancel()
+        for task in list(self.viewer_tasks.values()):
+            task.cancel()
+        self._clear_snapshot_subscriptions()
+        # pc.close() dispara connectionstatechange, que remove o peer de self.peers
+        for pc in list(self.peers.values()):
             await pc.close()
         self.peers.clear()
-        self.socket = None
+        for track in self.video_tracks.values():
+            track.stop()
+        self.video_tracks.clear()
+        for engine in self.capture_engines.values():
+            engine.close()
+        self.capture_engines.clear()
         print("🧹 Broadcaster encerrado e conexões limpas.")
 
 
 if __name__ == "__main__":
+    # Necessário para o modo de captura 'process' no executável do PyInstaller
+    multiprocessing.freeze_support()
     saved_config = load_broadcaster_config()
     
     if not saved_config:
@@ -706,7 +3126,9 @@ if __name__ == "__main__":
         broadcaster_token=broadcaster_token,
         broadcaster_id=broadcaster_id,
         is_installation=is_installation,
-        token_expires_at=token_expires_at
+        token_expires_at=token_expires_at,
+        video_config=saved_config.get('video'),
+        monitoring_config=saved_config.get('monitoring')
     )
     
     try:
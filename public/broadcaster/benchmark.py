@@ -0,0 +1,482 @@
+"""
+Medições de desempenho do Broadcaster.
+
+Uso:
+    python benchmark.py loop-lag [--synthetic 3840x2160] [--seconds 10]
+    python benchmark.py viewers [--synthetic 1920x1080] [--viewers 1 2 4] [--mixed] [--region 1280x720]
+    python benchmark.py encoders [--size 1920x1080] [--seconds 10]
+    python benchmark.py monitoring [--samples 300] [--history 200]
+    python benchmark.py collector [--ticks 200]
+    python benchmark.py startup [--runs 5]
+
+Com --synthetic a tela é simulada (útil em máquinas sem monitor); sem ele
+o monitor 1 real é capturado via mss.
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import zlib
+
+import numpy as np
+import psutil
+from aiortc.codecs import h264, vpx
+
+import Broadcaster as broadcaster_module
+from Broadcaster import (Broadcaster, CaptureProcessWorker, CaptureRung, MonitoringDeltaEncoder, ProcessInfoCache,
+                         ScreenCaptureEngine, apply_encoder_settings, encode_monitoring, pack_monitoring_payload)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class SyntheticShot:
+    """Imita o ScreenShot do mss: buffer BGRA novo a cada grab"""
+
+    def __init__(self, pixels):
+        self.height, self.width = pixels.shape[:2]
+        self.raw = bytearray(pixels.tobytes())
+
+    @property
+    def __array_interface__(self):
+        return {
+            'version': 3,
+            'shape': (self.height, self.width, 4),
+            'typestr': '|u1',
+            'data': self.raw,
+        }
+
+
+class SyntheticScreen:
+    """Imita mss.mss() com um único monitor e latência de grab configurável"""
+
+    def __init__(self, width, height, grab_latency):
+        self.monitors = [
+            {'left': 0, 'top': 0, 'width': width, 'height': height},
+            {'left': 0, 'top': 0, 'width': width, 'height': height},
+        ]
+        self.grab_latency = grab_latency
+        self.pixels = np.random.randint(0, 255, (height, width, 4), dtype=np.uint8)
+        self.counter = 0
+
+    def grab(self, monitor):
+        # Simula o tempo do BitBlt/XGetImage (sem GIL, como a chamada real via ctypes)
+        time.sleep(self.grab_latency)
+        self.counter += 1
+        self.pixels[monitor['top'], :, :] = self.counter % 255
+        return SyntheticShot(self.pixels[monitor['top']:monitor['top'] + monitor['height'],
+                                         monitor['left']:monitor['left'] + monitor['width']])
+
+    def close(self):
+        pass
+
+
+def synthetic_engine_class(width, height, grab_latency):
+    class SyntheticCaptureEngine(ScreenCaptureEngine):
+        def _open_screen(self):
+            return SyntheticScreen(width, height, grab_latency)
+
+    return SyntheticCaptureEngine
+
+
+class SyntheticCaptureWorker(CaptureProcessWorker):
+    """Processo de captura com tela sintética; a resolução vem do ambiente (o spawn não herda variáveis do módulo)"""
+
+    def _open_screen(self):
+        size, grab_latency_ms = os.environ['BENCHMARK_SYNTHETIC_SCREEN'].split(':')
+        width, height = (int(v) for v in size.split('x'))
+        return SyntheticScreen(width, height, float(grab_latency_ms) / 1000)
+
+
+async def measure_loop_lag(seconds, interval=0.01):
+    """Mede o atraso do event loop: quanto cada sleep(interval) passa do previsto"""
+    lags = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - started - interval) * 1000)
+    return lags
+
+
+async def consume(track, counter):
+    while True:
+        await track.recv()
+        counter[0] += 1
+
+
+async def run_loop_lag(engine_class, capture_mode, seconds, viewers):
+    engine = engine_class(monitor_number=1, capture_mode=capture_mode)
+    broadcaster_module.load_video_stack()
+    tracks = [broadcaster_module.ScreenCaptureTrack(engine) for _ in range(viewers)]
+    counter = [0]
+    consumers = [asyncio.create_task(consume(track, counter)) for track in tracks]
+    lags = await measure_loop_lag(seconds)
+    pacing = engine.pacer.stats()
+    for task in consumers:
+        task.cancel()
+    for track in tracks:
+        track.stop()
+    engine.close()
+
+    lags.sort()
+    return {
+        'mean': statistics.mean(lags),
+        'p95': lags[int(len(lags) * 0.95)],
+        'max': lags[-1],
+        'fps': counter[0] / viewers / seconds,
+        'jitter': pacing['jitter_ms'],
+        'dropped': pacing['dropped'],
+    }
+
+
+def cmd_loop_lag(args):
+    if args.synthetic:
+        width, height = (int(v) for v in args.synthetic.lower().split('x'))
+        engine_class = synthetic_engine_class(width, height, args.grab_latency_ms / 1000)
+        print(f"🧪 Tela sintética {width}x{height}, grab simulado de {args.grab_latency_ms}ms")
+    else:
+        engine_class = ScreenCaptureEngine
+
+    print(f"{'modo':<8} {'lag médio':>10} {'lag p95':>10} {'lag máx':>10} {'fps':>6} "
+          f"{'jitter':>8} {'descartados':>12}")
+    for capture_mode in ('inline', 'thread'):
+        result = asyncio.run(run_loop_lag(engine_class, capture_mode, args.seconds, args.viewers))
+        print(f"{capture_mode:<8} {result['mean']:>8.1f}ms {result['p95']:>8.1f}ms "
+              f"{result['max']:>8.1f}ms {result['fps']:>6.1f} {result['jitter']:>6.1f}ms "
+              f"{result['dropped']:>12}")
+
+
+async def encode_viewer(track, encoder, counter):
+    """Imita um RTCRtpSender: recebe o frame e codifica numa thread do executor"""
+    loop = asyncio.get_running_loop()
+    while True:
+        frame = await track.recv()
+        await loop.run_in_executor(None, encoder.encode, frame)
+        counter[0] += 1
+
+
+async def run_viewers(engine_class, capture_mode, viewers, seconds, mixed, encoder_class, region=None):
+    broadcaster_module.load_video_stack()
+    engine = engine_class(monitor_number=1, capture_mode=capture_mode, region=region)
+    engine.process_worker = SyntheticCaptureWorker
+    tracks = []
+    for index in range(viewers):
+        # --mixed: viewers em tela cheia, metade e um terço da resolução (3 degraus)
+        divisor = ScreenCaptureEngine.SCALE_LADDER[index % 3] if mixed else 1
+        tracks.append(broadcaster_module.ScreenCaptureTrack(
+            engine, max_width=engine.capture_rect['width'] // divisor,
+            max_height=engine.capture_rect['height'] // divisor))
+    counters = [[0] for _ in tracks]
+    tasks = [asyncio.create_task(encode_viewer(track, encoder_class(), counter))
+             for track, counter in zip(tracks, counters)]
+    # Aquecimento: processo de captura subindo e primeiros keyframes
+    await asyncio.sleep(2)
+    for counter in counters:
+        counter[0] = 0
+    process = psutil.Process()
+    cpu_start = process.cpu_times()
+    children_start = sum(child.cpu_times().user + child.cpu_times().system
+                         for child in process.children(recursive=True))
+    wall_start = time.perf_counter()
+    lags = await measure_loop_lag(seconds)
+    wall = time.perf_counter() - wall_start
+    cpu_end = process.cpu_times()
+    children_cpu = sum(child.cpu_times().user + child.cpu_times().system
+                       for child in process.children(recursive=True)) - children_start
+    for task in tasks:
+        task.cancel()
+    for track in tracks:
+        track.stop()
+    engine.close()
+
+    lags.sort()
+    main_cpu = (cpu_end.user + cpu_end.system) - (cpu_start.user + cpu_start.system)
+    return {
+        'fps': sum(counter[0] for counter in counters) / wall,
+        'per_viewer': min(counter[0] for counter in counters) / wall,
+        'p95': lags[int(len(lags) * 0.95)],
+        'main_cpu': main_cpu / wall * 100,
+        'worker_cpu': children_cpu / wall * 100,
+    }
+
+
+def cmd_viewers(args):
+    width, height = (int(v) for v in args.synthetic.lower().split('x'))
+    os.environ['BENCHMARK_SYNTHETIC_SCREEN'] = f"{width}x{height}:{args.grab_latency_ms}"
+    engine_class = synthetic_engine_class(width, height, args.grab_latency_ms / 1000)
+    encoder_class = h264.H264Encoder if args.codec == 'H264' else vpx.Vp8Encoder
+    region = None
+    if args.region:
+        region_width, region_height = (int(v) for v in args.region.lower().split('x'))
+        region = (0, 0, region_width, region_height)
+    print(f"🧪 Tela sintética {width}x{height}, {args.codec}, {args.seconds:g}s por medição, "
+          f"{os.cpu_count()} núcleo(s){', degraus mistos' if args.mixed else ''}"
+          f"{f', região {args.region}' if region else ''}")
+    print(f"{'modo':<8} {'viewers':>7} {'frames/s':>9} {'fps/viewer':>11} {'lag p95':>9} "
+          f"{'CPU principal':>14} {'CPU captura':>12}")
+    for capture_mode in args.modes:
+        for viewers in args.viewers:
+            result = asyncio.run(run_viewers(engine_class, capture_mode, viewers, args.seconds,
+                                             args.mixed, encoder_class, region))
+            print(f"{capture_mode:<8} {viewers:>7} {result['fps']:>9.1f} {result['per_viewer']:>11.1f} "
+                  f"{result['p95']:>7.1f}ms {result['main_cpu']:>13.0f}% {result['worker_cpu']:>11.0f}%")
+
+
+class SyntheticDesktop:
+    """
+    Conteúdo típico de desktop: fundo liso, barra de tarefas, janelas com
+    "texto" e uma linha sendo digitada + uma área rolando a cada frame.
+    """
+
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        rng = np.random.default_rng(42)
+        self.base = np.full((height, width, 4), 235, dtype=np.uint8)
+        self.base[height - 40:, :, :3] = (60, 50, 40)
+        for left, top, w, h in ((80, 60, 900, 700), (700, 200, 1000, 600)):
+            w, h = min(w, width - left), min(h, height - top - 40)
+            self.base[top:top + h, left:left + w, :3] = 255
+            self.base[top:top + 30, left:left + w, :3] = (120, 80, 30)
+            for row in range(top + 50, top + h - 20, 22):
+                length = int(rng.integers(w // 3, w - 40))
+                glyphs = rng.integers(0, 2, (12, length // 6), dtype=np.uint8) * 200
+                self.base[row:row + 12, left + 20:left + 20 + length // 6 * 6, :3] = \
+                    255 - np.repeat(glyphs, 6, axis=1)[:, :, None]
+        self.frame = self.base.copy()
+        self.counter = 0
+
+    def next(self):
+        self.counter += 1
+        # Digitação: a linha cresce alguns pixels por frame
+        typed = (self.counter * 4) % 800
+        self.frame[780:792, 100:100 + typed, :3] = 30
+        if typed == 0:
+            self.frame[780:792, :, :] = self.base[780:792, :, :]
+        # Rolagem: a segunda janela desloca uma linha por frame
+        self.frame[260:780, 720:1680] = np.roll(self.frame[260:780, 720:1680], -2, axis=0)
+        return self.frame
+
+
+def encode_run(encoder_class, frames, fps, bitrate, keyframe_interval):
+    encoder = encoder_class()
+    # Sem REMB do navegador: simula uma rede boa, que leva o alvo até o teto
+    encoder.target_bitrate = bitrate
+    time_base = fractions.Fraction(1, 90000)
+    keyframe_every = int(keyframe_interval * fps) if keyframe_interval else 0
+    total_bytes = 0
+    cpu_start = time.process_time()
+    for index, frame in enumerate(frames):
+        frame.pts = int(index * 90000 / fps)
+        frame.time_base = time_base
+        force_keyframe = index == 0 or (keyframe_every and index % keyframe_every == 0)
+        payloads, _ = encoder.encode(frame, force_keyframe=bool(force_keyframe))
+        total_bytes += sum(len(p) for p in payloads)
+    return time.process_time() - cpu_start, total_bytes
+
+
+def cmd_encoders(args):
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    frame_count = int(args.seconds * args.fps)
+    desktop = SyntheticDesktop(width, height)
+    broadcaster_module.load_video_stack()
+    rung = CaptureRung(1, 1, pool_size=frame_count)
+    frames = [rung.convert(desktop.next()) for _ in range(frame_count)]
+    print(f"🧪 Desktop sintético {width}x{height}, {args.seconds:g}s a {args.fps} fps")
+
+    print(f"{'codec':<6} {'bitrate máx':>12} {'keyframe':>9} {'CPU/s de vídeo':>15} {'kbps reais':>11}")
+    for max_bitrate in args.bitrates:
+        apply_encoder_settings({'max_bitrate': max_bitrate})
+        for name, encoder_class in (('H264', h264.H264Encoder), ('VP8', vpx.Vp8Encoder)):
+            for keyframe_interval in args.keyframe_intervals:
+                keyframe_label = f"{keyframe_interval:g}s" if keyframe_interval else "-"
+                cpu, total_bytes = encode_run(encoder_class, frames, args.fps, max_bitrate,
+                                              keyframe_interval)
+                print(f"{name:<6} {max_bitrate // 1000:>9}kbps {keyframe_label:>9} "
+                      f"{cpu / args.seconds * 1000:>12.0f}ms {total_bytes * 8 / args.seconds / 1000:>11.0f}")
+
+
+def synthetic_monitoring(samples, history_size):
+    """Sessão de monitoramento típica: 20 janelas, trocas de foco ocasionais"""
+    rng = random.Random(42)
+    names = ['chrome.exe', 'msedge.exe', 'EXCEL.EXE', 'WINWORD.EXE', 'explorer.exe', 'Teams.exe', 'OUTLOOK.EXE']
+    apps = [{'title': f"Documento {i} - Relatório mensal de vendas - {names[i % len(names)]}",
+             'app': names[i % len(names)], 'pid': 1000 + i} for i in range(20)]
+    history = [{'browser': 'Chrome', 'url': f"https://intranet.exemplo.com.br/pedidos/{i}?aba=itens",
+                'title': f"Pedido {i} - Intranet", 'timestamp': f"2026-01-01T09:{i // 60 % 60:02d}:{i % 60:02d}"}
+               for i in range(history_size)]
+    session = []
+    for tick in range(samples):
+        if rng.random() < 0.03:
+            apps = apps[1:] + [{'title': f"Nova janela {tick}", 'app': rng.choice(names), 'pid': 5000 + tick}]
+        session.append({
+            'type': 'monitoring',
+            'timestamp': f"2026-01-01T09:00:{tick % 60:02d}.{tick:06d}",
+            'host': 'ESTACAO-042',
+            'apps': list(apps),
+            'foreground': apps[tick // 40 % len(apps)],
+            'system': 'Windows',
+            'idle_seconds': round(rng.random() * 3, 1),
+            'active_url': None,
+            'is_idle': False,
+            'browser_history': [],
+        })
+    return session, {'type': 'monitoring', 'browser_history': history}
+
+
+def monitoring_codecs():
+    codecs = [
+        ('json', lambda m: json.dumps(m).encode('utf-8')),
+        ('json compacto', lambda m: encode_monitoring(m).encode('utf-8')),
+        ('json+zlib', lambda m: zlib.compress(encode_monitoring(m).encode('utf-8'), 6)),
+        ('json+deflate', lambda m: pack_monitoring_payload(encode_monitoring(m), True)),
+    ]
+    if msgpack:
+        codecs += [
+            ('msgpack', msgpack.packb),
+            ('msgpack+zlib', lambda m: zlib.compress(msgpack.packb(m), 6)),
+        ]
+    return codecs
+
+
+def measure_codec(codec, messages, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        total_bytes = sum(len(codec(message)) for message in messages)
+    elapsed = (time.perf_counter() - started) / repeat
+    return elapsed / len(messages) * 1e6, total_bytes / len(messages)
+
+
+def cmd_monitoring(args):
+    session, history = synthetic_monitoring(args.samples, args.history)
+    encoder = MonitoringDeltaEncoder()
+    encoded = [encoder.encode(sample) for sample in session]
+    scenarios = [
+        ('amostra completa', session),
+        ('delta/keyframe', encoded),
+        (f"histórico ({args.history})", [history]),
+    ]
+    print(f"🧪 {args.samples} amostras com 20 janelas; lote de histórico com {args.history} visitas")
+    if not msgpack:
+        print("ℹ️ msgpack não instalado, comparando só as variações de JSON")
+
+    print(f"{'cenário':<18} {'codificação':<14} {'µs/msg':>8} {'bytes/msg':>10}")
+    for label, messages in scenarios:
+        for name, codec in monitoring_codecs():
+            micros, size = measure_codec(codec, messages, args.repeat)
+            print(f"{label:<18} {name:<14} {micros:>8.1f} {size:>10.0f}")
+
+
+def cmd_collector(args):
+    broadcaster = Broadcaster('ws://localhost')
+    print(f"🧪 {args.ticks} coletas de janelas/processos nesta máquina")
+    print(f"{'cache':<10} {'CPU/tick':>10} {'consultas/tick':>15}")
+    for label, cold in (('frio', True), ('quente', False)):
+        broadcaster.process_cache = ProcessInfoCache()
+        broadcaster.get_active_windows()
+        lookups = 0
+        cpu_start = time.process_time()
+        for _ in range(args.ticks):
+            if cold:
+                broadcaster.process_cache = ProcessInfoCache()
+            before = broadcaster.process_cache.lookups
+            broadcaster.get_active_windows()
+            lookups += broadcaster.process_cache.lookups - before
+        cpu = (time.process_time() - cpu_start) / args.ticks
+        print(f"{label:<10} {cpu * 1e6:>8.0f}µs {lookups / args.ticks:>15.1f}")
+
+
+STARTUP_PROBE = """
+import json, time, psutil
+process = psutil.Process()
+rss_start = process.memory_info().rss
+started = time.perf_counter()
+import Broadcaster
+imported = time.perf_counter()
+rss_monitoring = process.memory_info().rss
+Broadcaster.load_video_stack()
+loaded = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'monitoring_mb': (rss_monitoring - rss_start) / 2 ** 20,
+    'video_ms': (loaded - imported) * 1000,
+    'video_mb': (process.memory_info().rss - rss_monitoring) / 2 ** 20,
+    'total_mb': process.memory_info().rss / 2 ** 20,
+}))
+"""
+
+
+def cmd_startup(args):
+    # Cada medição num interpretador novo, para nada já estar importado
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=here,
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    print(f"🧪 Importação do Broadcaster (mediana de {args.runs} execuções)")
+    print(f"{'etapa':<24} {'tempo':>10} {'RSS':>10}")
+    print(f"{'só monitoramento':<24} {median['import_ms']:>8.0f}ms {median['monitoring_mb']:>8.1f}MB")
+    print(f"{'+ pilha de vídeo':<24} {median['video_ms']:>8.0f}ms {median['video_mb']:>8.1f}MB")
+    print(f"RSS total com vídeo: {median['total_mb']:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Medições de desempenho do Broadcaster")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    loop_lag = subparsers.add_parser('loop-lag', help="Atraso do event loop com captura inline vs thread")
+    loop_lag.add_argument('--synthetic', help="Resolução da tela simulada, ex: 3840x2160")
+    loop_lag.add_argument('--grab-latency-ms', type=float, default=15.0)
+    loop_lag.add_argument('--seconds', type=float, default=10.0)
+    loop_lag.add_argument('--viewers', type=int, default=1)
+    loop_lag.set_defaults(func=cmd_loop_lag)
+
+    viewers = subparsers.add_parser('viewers', help="Frames codificados por segundo conforme viewers entram, thread vs processo")
+    viewers.add_argument('--synthetic', default='1920x1080', help="Resolução da tela simulada")
+    viewers.add_argument('--grab-latency-ms', type=float, default=15.0)
+    viewers.add_argument('--seconds', type=float, default=10.0)
+    viewers.add_argument('--viewers', type=int, nargs='+', default=[1, 2, 4])
+    viewers.add_argument('--modes', nargs='+', default=['thread', 'process'])
+    viewers.add_argument('--codec', choices=['VP8', 'H264'], default='VP8')
+    viewers.add_argument('--mixed', action='store_true', help="Viewers em degraus de resolução diferentes")
+    viewers.add_argument('--region', help="Captura só esta área do canto da tela, ex: 1280x720")
+    viewers.set_defaults(func=cmd_viewers)
+
+    encoders = subparsers.add_parser('encoders', help="CPU por segundo codificado, H.264 vs VP8")
+    encoders.add_argument('--size', default='1920x1080')
+    encoders.add_argument('--seconds', type=float, default=10.0)
+    encoders.add_argument('--fps', type=int, default=30)
+    encoders.add_argument('--bitrates', type=int, nargs='+', default=[1000000, 3000000])
+    encoders.add_argument('--keyframe-intervals', type=float, nargs='+', default=[0, 2])
+    encoders.set_defaults(func=cmd_encoders)
+
+    monitoring = subparsers.add_parser('monitoring', help="Tempo e bytes por mensagem de monitoramento")
+    monitoring.add_argument('--samples', type=int, default=300)
+    monitoring.add_argument('--history', type=int, default=200)
+    monitoring.add_argument('--repeat', type=int, default=5)
+    monitoring.set_defaults(func=cmd_monitoring)
+
+    collector = subparsers.add_parser('collector', help="CPU por tick da coleta de janelas, com e sem cache")
+    collector.add_argument('--ticks', type=int, default=200)
+    collector.set_defaults(func=cmd_collector)
+
+    startup = subparsers.add_parser('startup', help="Tempo de importação e RSS com e sem a pilha de vídeo")
+    startup.add_argument('--runs', type=int, default=5)
+    startup.set_defaults(func=cmd_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
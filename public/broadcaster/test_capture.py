@@ -0,0 +1,47 @@
+"""
+Testes da captura compartilhada (tela sintética, sem monitor real).
+
+Uso:
+    python -m unittest test_capture
+"""
+import asyncio
+import unittest
+
+import Broadcaster as broadcaster_module
+from Broadcaster import ViewerQuality
+from benchmark import synthetic_engine_class
+
+
+class SwitchRungTest(unittest.TestCase):
+
+    def setUp(self):
+        broadcaster_module.load_video_stack()
+        self.engine_class = synthetic_engine_class(640, 360, 0.001)
+
+    def test_switch_rung_wakes_pending_recv(self):
+        async def scenario():
+            engine = self.engine_class(monitor_number=1, capture_mode='thread')
+            track = broadcaster_module.ScreenCaptureTrack(engine)
+            try:
+                await asyncio.wait_for(track.recv(), 2)
+                # recv pendente no degrau antigo enquanto o controle de congestionamento troca o degrau
+                pending = asyncio.create_task(track.recv())
+                await asyncio.sleep(0)
+                quality = ViewerQuality()
+                quality.level = 1
+                track.switch_rung(quality.rung_key(track.requested_rung))
+                frame = await asyncio.wait_for(pending, 2)
+                self.assertEqual(list(engine.rungs), [track.rung.key])
+                self.assertEqual((frame.width, frame.height),
+                                 track.rung.size_for(engine.capture_rect['width'], engine.capture_rect['height']))
+                # E continua recebendo frames no degrau novo
+                await asyncio.wait_for(track.recv(), 2)
+            finally:
+                track.stop()
+                engine.close()
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
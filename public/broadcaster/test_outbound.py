@@ -0,0 +1,57 @@
+"""
+Testes da fila de saída do WebSocket de sinalização (socket falso).
+
+Uso:
+    python -m unittest test_outbound
+"""
+import asyncio
+import unittest
+
+from Broadcaster import OutboundQueue
+
+
+class FakeSocket:
+
+    def __init__(self, fail_on=()):
+        self.sent = []
+        self.fail_on = set(fail_on)
+
+    async def send(self, payload):
+        if payload in self.fail_on:
+            raise ValueError(f"falha simulada em {payload}")
+        self.sent.append(payload)
+
+
+class OutboundQueueTest(unittest.TestCase):
+
+    def test_failed_item_does_not_stop_writer(self):
+        async def scenario():
+            socket = FakeSocket(fail_on={'ruim'})
+            outbound = OutboundQueue(socket)
+            try:
+                failed = asyncio.create_task(outbound.send('ruim', OutboundQueue.MONITORING))
+                delivered = await asyncio.wait_for(outbound.send('bom', OutboundQueue.MONITORING), 2)
+                self.assertFalse(await failed)
+                self.assertTrue(delivered)
+                self.assertEqual(socket.sent, ['bom'])
+            finally:
+                outbound.close()
+
+        asyncio.run(scenario())
+
+    def test_put_candidate_after_close_is_dropped(self):
+        async def scenario():
+            socket = FakeSocket()
+            outbound = OutboundQueue(socket)
+            outbound.close()
+            outbound.put_candidate('viewer', {'candidate': 'c'})
+            await asyncio.sleep(0)
+            self.assertFalse(any(outbound.queues))
+            self.assertEqual(outbound.candidates, {})
+            self.assertEqual(socket.sent, [])
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ document.addEventListener("DOMContentLoaded", () => {
   const broadcasterSelect = document.getElementById('broadcasterSelect');
   const broadcasterSearch = document.getElementById('broadcasterSearch');
   const monitorSelect = document.getElementById('monitorSelect');
+  const regionSelect = document.getElementById('regionSelect');
   const remoteVideo = document.getElementById('remoteVideo');
   const statusDiv = document.getElementById('status');
   const statusDot = document.getElementById('statusDot');
@@ -458,7 +459,8 @@ document.addEventListener("DOMContentLoaded", () => {
     socket.send(JSON.stringify({
       type: "watch",
       targetId: selectedBroadcasterId,
-      monitor_number: selectedMonitorNumber
+      monitor_number: selectedMonitorNumber,
+      region: regionSelect.value || undefined
     }));
 
     exportActivitiesButton.disabled = false;
@@ -87,7 +87,10 @@ router.get('/export/excel', authenticateToken, async (req, res) => {
       const timestamp = new Date(activity.timestamp);
       
       let elapsed = 2;
-      if (i < sortedActivities.length - 1) {
+      if (activity.duration_seconds != null) {
+        // Intervalo agregado pelo broadcaster: já traz a própria duração
+        elapsed = activity.duration_seconds;
+      } else if (i < sortedActivities.length - 1) {
         const nextActivity = sortedActivities[i + 1];
         elapsed = (new Date(nextActivity.timestamp) - timestamp) / 1000;
         if (elapsed > 120) elapsed = 2;
@@ -144,6 +144,11 @@ async function addActivity(broadcasterId, data) {
     foreground: data.foreground || null,
     apps_count: data.apps ? data.apps.length : 0
   };
+
+  if (data.duration_seconds != null) {
+    activity.ended_at = data.ended_at;
+    activity.duration_seconds = data.duration_seconds;
+  }
   
   activitiesCache.push(activity);
   
@@ -191,21 +196,23 @@ async function getStats(broadcasterId, fromDate, toDate) {
   let activeTime = 0;
   
   activities.forEach(activity => {
+    const seconds = activity.duration_seconds ?? 2;
+
     if (activity.active_url) {
-      urlCounts[activity.active_url] = (urlCounts[activity.active_url] || 0) + 1;
+      urlCounts[activity.active_url] = (urlCounts[activity.active_url] || 0) + seconds / 2;
     }
     
     if (activity.is_idle) {
-      totalIdleTime += 2;
+      totalIdleTime += seconds;
     } else {
-      activeTime += 2;
+      activeTime += seconds;
     }
   });
   
   const topUrls = Object.entries(urlCounts)
     .sort((a, b) => b[1] - a[1])
     .slice(0, 20)
-    .map(([url, count]) => ({ url, count }));
+    .map(([url, count]) => ({ url, count: Math.round(count) }));
   
   return {
     totalRecords: activities.length,
@@ -3,13 +3,19 @@ const db = require('../database/db');
 class DatabaseStorage {
   
   async saveActivity(broadcasterId, activityData) {
-    const { installation_id, idle_seconds, active_url, foreground_app, app_count, apps } = activityData;
+    const { installation_id, idle_seconds, active_url, foreground_app, app_count, apps,
+            timestamp, ended_at, duration_seconds } = activityData;
     
     try {
+      // Sem horário, vale o de chegada; intervalos agregados trazem início, fim e duração.
+      // Horários do broadcaster vêm em UTC com fuso: o cast para timestamptz os converte
+      // para o fuso da sessão, o mesmo referencial do CURRENT_TIMESTAMP
       await db.query(
-        `INSERT INTO activities (broadcaster_id, installation_id, idle_seconds, active_url, foreground_app, app_count, apps_data)
-         VALUES ($1, $2, $3, $4, $5, $6, $7)`,
-        [broadcasterId, installation_id || null, idle_seconds || 0, active_url, foreground_app, app_count || 0, JSON.stringify(apps || [])]
+        `INSERT INTO activities (broadcaster_id, installation_id, idle_seconds, active_url, foreground_app, app_count, apps_data,
+                                 timestamp, ended_at, duration_seconds)
+         VALUES ($1, $2, $3, $4, $5, $6, $7, COALESCE($8::timestamptz, CURRENT_TIMESTAMP), $9::timestamptz, $10)`,
+        [broadcasterId, installation_id || null, idle_seconds || 0, active_url, foreground_app, app_count || 0, JSON.stringify(apps || []),
+         timestamp || null, ended_at || null, duration_seconds ?? null]
       );
     } catch (error) {
       console.error('Error saving activity:', error);
@@ -78,7 +84,7 @@ class DatabaseStorage {
   
   async getActivities(broadcasterId, startDate, endDate, limit = 1000) {
     const result = await db.query(
-      `SELECT id, timestamp, idle_seconds, active_url, foreground_app, app_count, apps_data
+      `SELECT id, timestamp, ended_at, duration_seconds, idle_seconds, active_url, foreground_app, app_count, apps_data
        FROM activities
        WHERE broadcaster_id = $1 
          AND timestamp >= $2 
@@ -115,11 +121,13 @@ class DatabaseStorage {
   }
   
   async getStatistics(broadcasterId, startDate, endDate) {
+    // Como nos rankings abaixo, cada registro vale sua duração em amostras de 2s:
+    // um intervalo agregado conta o mesmo que as amostras avulsas que ele substitui
     const activitiesResult = await db.query(
       `SELECT 
-         COUNT(*) as total_activities,
-         SUM(idle_seconds) as total_idle_seconds,
-         AVG(app_count) as avg_app_count,
+         ROUND(SUM(COALESCE(duration_seconds, 2)) / 2.0) as total_activities,
+         ROUND(SUM(idle_seconds * COALESCE(duration_seconds, 2)) / 2.0) as total_idle_seconds,
+         SUM(app_count * COALESCE(duration_seconds, 2))::float / NULLIF(SUM(COALESCE(duration_seconds, 2)), 0) as avg_app_count,
          MAX(timestamp) as last_activity
        FROM activities
        WHERE broadcaster_id = $1
@@ -129,7 +137,7 @@ class DatabaseStorage {
     );
     
     const urlsResult = await db.query(
-      `SELECT active_url, COUNT(*) as count
+      `SELECT active_url, ROUND(SUM(COALESCE(duration_seconds, 2)) / 2.0) as count
        FROM activities
        WHERE broadcaster_id = $1
          AND timestamp >= $2
@@ -142,7 +150,7 @@ class DatabaseStorage {
     );
     
     const appsResult = await db.query(
-      `SELECT foreground_app, COUNT(*) as count
+      `SELECT foreground_app, ROUND(SUM(COALESCE(duration_seconds, 2)) / 2.0) as count
        FROM activities
        WHERE broadcaster_id = $1
          AND timestamp >= $2
@@ -0,0 +1,107 @@
+// sessions.js
+const crypto = require("crypto");
+
+// Sessões retomáveis de broadcasters: ao reconectar dentro do prazo, o
+// broadcaster apresenta o session_token e pula a autenticação completa
+const SESSION_TTL = 5 * 60 * 1000;
+// Prazo absoluto desde a última autenticação completa: retomadas sucessivas
+// não estendem a sessão além disso, e a instalação volta a ser verificada no banco
+const SESSION_MAX_AGE = (parseInt(process.env.BROADCASTER_SESSION_MAX_AGE) || 30 * 60) * 1000;
+// O token é assinado para que a identidade sobreviva a um reinício do servidor.
+// A chave é derivada do JWT_SECRET, mas distinta dele: um token de sessão não
+// serve como JWT de viewer. Sem segredo configurado, vale só neste processo
+const SESSION_SECRET = process.env.JWT_SECRET
+  ? crypto.createHmac("sha256", process.env.JWT_SECRET).update("broadcaster-session").digest()
+  : crypto.randomBytes(32);
+const STARTED_AT = Date.now();
+const sessions = new Map();
+// Tokens anteriores ao reinício já retomados: continuam sendo de uso único
+const takenSessionIds = new Map();
+
+function sign(payload) {
+  return crypto.createHmac("sha256", SESSION_SECRET).update(payload).digest("base64url");
+}
+
+// Só a identidade vai no token; o estado de monitoramento fica na memória
+function newSessionToken(data) {
+  const payload = Buffer.from(JSON.stringify({
+    sid: crypto.randomBytes(12).toString("hex"),
+    iat: Date.now(),
+    authenticatedAt: data.authenticatedAt,
+    db_id: data.db_id,
+    installation_id: data.installation_id,
+    broadcaster_group_name: data.broadcaster_group_name,
+    name: data.name
+  })).toString("base64url");
+  return `${payload}.${sign(payload)}`;
+}
+
+function readSessionToken(token) {
+  if (typeof token !== "string") return null;
+  const [payload, signature] = token.split(".");
+  if (!payload || !signature) return null;
+  const expected = Buffer.from(sign(payload));
+  const received = Buffer.from(signature);
+  if (expected.length !== received.length || !crypto.timingSafeEqual(expected, received)) return null;
+  try {
+    return JSON.parse(Buffer.from(payload, "base64url").toString());
+  } catch (err) {
+    return null;
+  }
+}
+
+// authenticatedAt: instante da autenticação completa que originou a cadeia de retomadas
+function saveSession(data) {
+  const authenticatedAt = data.authenticatedAt || Date.now();
+  const token = newSessionToken({ ...data, authenticatedAt });
+  sessions.set(token, { ...data, authenticatedAt, expiresAt: sessionExpiry(authenticatedAt) });
+  return { token, session: sessions.get(token) };
+}
+
+function sessionExpiry(authenticatedAt) {
+  return Math.min(Date.now() + SESSION_TTL, authenticatedAt + SESSION_MAX_AGE);
+}
+
+// Sessões são de uso único: quem retoma recebe um token novo no auth-success
+function takeSession(token) {
+  const claims = readSessionToken(token);
+  if (!claims) return null;
+  const session = sessions.get(token);
+  if (session) {
+    sessions.delete(token);
+    return session.expiresAt > Date.now() ? session : null;
+  }
+  // Fora da memória: só vale um token emitido antes do reinício, ainda no
+  // prazo absoluto e não retomado desde então. O estado de monitoramento se
+  // perdeu, então o broadcaster recomeça os deltas com um keyframe
+  const expiresAt = claims.authenticatedAt + SESSION_MAX_AGE;
+  if (claims.iat >= STARTED_AT || expiresAt <= Date.now() || takenSessionIds.has(claims.sid)) return null;
+  takenSessionIds.set(claims.sid, expiresAt);
+  return {
+    db_id: claims.db_id,
+    installation_id: claims.installation_id,
+    broadcaster_group_name: claims.broadcaster_group_name,
+    name: claims.name,
+    monitoringState: null,
+    authenticatedAt: claims.authenticatedAt,
+    expiresAt
+  };
+}
+
+// Mantém a sessão viva enquanto o broadcaster está ativo
+function touchSession(session) {
+  session.expiresAt = sessionExpiry(session.authenticatedAt);
+}
+
+// Limpeza periódica das sessões expiradas
+setInterval(() => {
+  const now = Date.now();
+  for (const [token, session] of sessions) {
+    if (session.expiresAt <= now) sessions.delete(token);
+  }
+  for (const [sid, expiresAt] of takenSessionIds) {
+    if (expiresAt <= now) takenSessionIds.delete(sid);
+  }
+}, 60000).unref();
+
+module.exports = { SESSION_TTL, SESSION_MAX_AGE, saveSession, takeSession, touchSession };
@@ -1,8 +1,12 @@
 const WebSocket = require("ws");
 const url = require("url");
 const jwt = require("jsonwebtoken");
+const zlib = require("zlib");
 const { peers, broadcasters, createPeer, deletePeer, setupHeartbeat } = require("./services/peers");
-const { registerBroadcaster, registerViewer, handleWatch, relayMessage, handleDisconnect, handleMonitoring, handleTokenRenewal } = require("./handlers/handlers");
+const { registerBroadcaster, registerViewer, handleWatch, handleSnapshotRequest, relaySnapshot, relayMessage, relayCandidates, handleDisconnect, handleMonitoring, handleMonitoringDelta, handleMonitoringBatch, handleBrowserHistory, handleTokenRenewal } = require("./handlers/handlers");
+
+// Teto do JSON descomprimido de um frame binário: barra bombas de compressão
+const MAX_INFLATED_MESSAGE = (parseInt(process.env.MAX_INFLATED_MESSAGE_MB) || 8) * 1024 * 1024;
 
 // inicia o heartbeat global para todos os peers
 setupHeartbeat();
@@ -44,16 +48,10 @@ function setupWebSocket(server) {
     const id = createPeer(ws);
     console.log(`🔗 Novo peer conectado: ${id}`);
 
-    // Recebe mensagens dos peers e chama os handlers adequados
-    ws.on("message", async (message) => {
-      let msg;
-      try {
-        msg = JSON.parse(message);
-      } catch {
-        console.error("Mensagem inválida:", message);
-        return;
-      }
-
+    // Trata as mensagens que dependem de estado (registro, monitoramento) na
+    // ordem de chegada: sem isso um lote ainda gravando se intercalaria com o
+    // delta do frame seguinte
+    const dispatch = async (msg) => {
       switch (msg.type) {
         case "broadcaster":
           await registerBroadcaster(ws, id, msg, peers, broadcasters);
@@ -64,22 +62,73 @@ function setupWebSocket(server) {
         case "watch":
           await handleWatch(ws, id, msg, peers, broadcasters);
           break;
-        case "offer":
-        case "answer":
-        case "candidate":
-          relayMessage(id, msg, peers);
+        case "snapshot-subscribe":
+        case "snapshot-unsubscribe":
+        case "snapshot-request":
+          await handleSnapshotRequest(ws, id, msg, peers, broadcasters);
           break;
         case "monitoring":
           await handleMonitoring(id, msg, peers, broadcasters);
           break;
+        case "monitoring-delta":
+          await handleMonitoringDelta(ws, id, msg, peers, broadcasters);
+          break;
+        case "monitoring-batch":
+          await handleMonitoringBatch(ws, id, msg, peers, broadcasters);
+          break;
+        case "browser-history":
+          await handleBrowserHistory(id, msg, broadcasters);
+          break;
         case "renew-token":
           await handleTokenRenewal(ws, id, broadcasters);
           break;
       }
+    };
+    let queue = Promise.resolve();
+
+    // Recebe mensagens dos peers e chama os handlers adequados
+    ws.on("message", (message, isBinary) => {
+      let msg;
+      if (isBinary && !broadcasters.get(id)?.capabilities?.includes("monitoring-deflate")) {
+        // Só broadcasters que negociaram "monitoring-deflate" enviam frames binários
+        console.warn(`⚠️ Frame binário inesperado de ${id} ignorado`);
+        return;
+      }
+      try {
+        // Frames binários são JSON comprimido com zlib ("monitoring-deflate")
+        msg = JSON.parse(isBinary ? zlib.inflateSync(message, { maxOutputLength: MAX_INFLATED_MESSAGE }) : message);
+      } catch {
+        console.error("Mensagem inválida:", message);
+        return;
+      }
+
+      // Repasses de sinalização são síncronos e não esperam gravações na fila
+      switch (msg.type) {
+        case "snapshot":
+          relaySnapshot(id, msg, peers);
+          return;
+        case "offer":
+        case "answer":
+        case "candidate":
+          relayMessage(id, msg, peers);
+          return;
+        case "candidates":
+          relayCandidates(id, msg, peers);
+          return;
+      }
+
+      queue = queue.then(() => dispatch(msg)).catch(err => {
+        console.error(`Erro ao tratar mensagem "${msg.type}" de ${id}:`, err);
+      });
     });
 
     // Tratamento de fechamento de conexão
-    ws.on("close", async () => await handleDisconnect(ws, id, peers, broadcasters, deletePeer));
+    // Depois do que ainda está na fila, para gravar as amostras pendentes por último
+    ws.on("close", () => {
+      queue = queue.then(() => handleDisconnect(ws, id, peers, broadcasters, deletePeer)).catch(err => {
+        console.error(`Erro ao desconectar ${id}:`, err);
+      });
+    });
   });
 
   console.log("🛰️ WebSocket server rodando com autenticação seletiva (só viewers)");